@@ -1,250 +1,490 @@
-class ExpressionParser:
+from collections import deque, namedtuple
+from functools import lru_cache
+from railroadBib import END_MARKER_ID
+from diagramGenerator import Kind, parse_regex, terminal_ids
+
+# Automata with more reachable states than this get no canonical state numbers
+CANONICAL_MAX_STATES = 500
+
+# position: index of the first symbol that cannot be read, len(word) for a valid but
+# unfinished prefix, None for an accepted word
+MatchResult = namedtuple("MatchResult", ["accepted", "position"])
+
+
+def bits(mask):
+    """
+    Yield the indices of the set bits of mask in increasing order.
     """
-    A parser for modifying and normalizing regular expressions by adding dots ('.')
-    and handling specific constructs like brackets, alternatives, and scopes.
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class PositionAutomaton:
+    """
+    A compiled form of a regex, built from the tree returned by parse_regex
+    (the same tree the diagram is drawn from).
+
+    A state is a bitset (an int) of the terminals that have a dot in front of them:
+    bit k is the k-th terminal in source order, which is also the order of the
+    diagram's terminal ids, and bit len(terminals) stands for a dot at the very end.
+
+    For every gap between characters we precompute where a dot placed there flows
+    to without consuming a symbol (entering a group, skipping an optional part,
+    looping a repetition, leaving through '|'). From that every terminal gets a
+    follow mask (the normalized state after reading it) and every symbol a mask of
+    the terminals carrying it, so a step is an AND with the symbol mask and an OR
+    of the follow masks of the bits that survive. Steps and state descriptions are
+    memoized, so their cost does not depend on the length of the expression.
     """
 
     def __init__(self, expression, list_id):
         """
-        Initialize the ExpressionParser with a given expression.
+        Compile the expression (dots are ignored) with the terminal ids of its diagram.
         """
-        self.expression = expression
-        self.list_id = list_id
-        self.add_dot()
-        self.update_comas()
-
-    def add_dot(self):
-        """
-        Add a dot ('.') between certain characters in the expression.
-        """
-        modified_expression = "."
-        in_brackets = 0
-        i = 0
-        while i < len(self.expression):
-            current_char = self.expression[i]
-            modified_expression += current_char
-            if current_char in "([{":
-                in_brackets += 1
-            elif current_char in ")]}":
-                in_brackets -= 1
-            elif current_char == '|' and in_brackets == 0:
-                modified_expression += '.'
-            i += 1
-        self.expression = modified_expression
-
-    def move_all(self, char):
-        """
-        Move all instances of a specified character to the front.
-        """
-        result_expression = ""
-        i = 0
-        while i < len(self.expression):
-            current_char = self.expression[i]
-            if current_char == '.':
-                if i < len(self.expression) - 1 and self.expression[i + 1] == char:
-                    result_expression += char + '.'
-                    i += 2
-                else:
-                    i += 1
-            else:
-                result_expression += current_char
-                i += 1
-        self.expression = result_expression
-
-    def update_comas(self):
-        """
-        Update the expression by repeatedly processing it so that dots ('.')
-        are correctly placed.
-        """
-        expression1 = self._update_comas_extra()
-        while expression1 != self.expression:
-            self.expression = expression1
-            expression1 = self._update_comas_extra()
-
-    def _parse_alternative(self, result_expression, i):
-        """
-        Handle alternative constructs (e.g., '|') in the expression.
-        """
-        ever = False
-        i += 1
-        brackets = 0
-        while i < len(self.expression):
-            if self.expression[i] in "([{":
-                brackets += 1
-            if self.expression[i] in ")]}":
-                if brackets == 0:
-                    if self.expression[i] == "}":
-                        while self.expression[i + 1] == "}":
-                            result_expression += self.expression[i]
-                            i += 1
-                            result_expression = self._back_coma_to_start(result_expression, i - 1)
-                    result_expression += self.expression[i] + '.'
-                    ever = True
-                    if self.expression[i] == '}':
-                        result_expression = self._back_coma_to_start(result_expression, i - 1)
-                    i += 1
-                    brackets -= 100
-                else:
-                    result_expression += self.expression[i]
-                    i += 1
-                    brackets -= 1
-            else:
-                result_expression += self.expression[i]
-                i += 1
-        if not ever:
-            result_expression += '.'
-        return result_expression
-
-    def _back_coma_to_start(self, result_expression, i):
-        """
-        Add a dot ('.') before a construct starting with '{'.
-        """
-        i -= 1
-        brackets = 0
-        while i > 0:
-            if result_expression[i] == '}':
-                brackets += 1
-            if result_expression[i] == '{':
-                if brackets == 0:
-                    break
-                else:
-                    brackets -= 1
-            i -= 1
-        left_part = result_expression[:i]
-        right_part = result_expression[i:]
-        result_expression = left_part + '.' + right_part
-        return result_expression
-
-    def _remove_duplicate_dots(self, expression):
-        """
-        Remove consecutive dots ('.') from the expression.
-        """
-        result = ""
-        i = 0
-        while i < len(expression):
-            if expression[i] == '.' and i + 1 < len(expression) and expression[i + 1] == '.':
-                i += 1
+        self.expression = expression.replace(".", "")
+        # parse_regex is cached, so this is the tree the diagram was built from
+        self.tree = parse_regex(self.expression)
+        self.terminals = list(self.tree.terminals())
+        self.list_id = list(list_id)
+        self.length = len(self.expression)
+        self.end = len(self.terminals)
+        self._ordinal = {node.start: k for k, node in enumerate(self.terminals)}
+        self._epsilon = [None] * self.length
+        self._link(self.tree)
+        self.end_mask = 1 << self.end
+        self.follow = [self.closure((node.end,)) for node in self.terminals]
+        self.symbol_masks = {}
+        for k, node in enumerate(self.terminals):
+            self.symbol_masks[node.symbol] = self.symbol_masks.get(node.symbol, 0) | 1 << k
+        self.initial = self.closure(self.start_gaps())
+        self.transitions = {}
+        self.states = {}
+        self._canonical = None
+
+    @staticmethod
+    def _entries(node):
+        """
+        Gaps a dot entering node lands on: the start of each of its alternatives.
+        """
+        if node.kind == Kind.CHOICE:
+            return [branch.start for branch in node.children]
+        return [node.start]
+
+    def _link(self, tree):
+        """
+        Fill the epsilon table for every bracket and '|' of the tree.
+        """
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if node.kind == Kind.CHOICE:
+                # A dot before '|' has finished its alternative and leaves the whole choice
+                for branch in node.children[:-1]:
+                    self._epsilon[branch.end] = [node.end]
+            elif node.kind in (Kind.GROUP, Kind.OPTIONAL, Kind.REPETITION):
+                opening = self._entries(node.children[0])
+                closing = [node.end]
+                if node.kind != Kind.GROUP:
+                    opening.append(node.end)
+                if node.kind == Kind.REPETITION:
+                    closing.append(node.start)
+                self._epsilon[node.start] = opening
+                self._epsilon[node.end - 1] = closing
+            stack.extend(node.children)
+
+    def start_gaps(self):
+        """
+        Gaps that hold a dot before anything is read: the start of the expression
+        and the start of every top-level alternative.
+        """
+        return self._entries(self.tree)
+
+    def closure(self, gaps):
+        """
+        Normalize a collection of dot positions (gaps) into a state mask.
+        """
+        state = 0
+        seen = set()
+        pending = list(gaps)
+        while pending:
+            gap = pending.pop()
+            if gap in seen:
+                continue
+            seen.add(gap)
+            if gap == self.length:
+                state |= self.end_mask
+            elif gap in self._ordinal:
+                state |= 1 << self._ordinal[gap]
             else:
-                result += expression[i]
-                i += 1
-        return result
-
-    def _update_comas_extra(self):
-        """
-        Process self.expression to ensure proper placement of dots ('.')
-        and handle constructs like brackets and alternatives.
-        """
-        self.in_brackets = 0
-        result_expression = ""
-        dot_after_scope = 0
-        i = 0
-        while i < len(self.expression):
-            if self.expression[i] == '.':
-                if i + 1 >= len(self.expression):
-                    result_expression += self.expression[i]
-                    i += 1
-                    continue
-                if self.expression[i + 1] in "])}":
-                    self.in_brackets -= 1
-                    if self.expression[i + 1] in "])":
-                        result_expression += self.expression[i + 1] + self.expression[i]
-                        i += 2
+                pending.extend(self._epsilon[gap])
+        return state
+
+    def step(self, state, symbol):
+        """
+        Return the state reached from state by reading symbol.
+        """
+        key = (state, symbol)
+        target = self.transitions.get(key)
+        if target is None:
+            target = 0
+            for k in bits(state & self.symbol_masks.get(symbol, 0)):
+                target |= self.follow[k]
+            self.transitions[key] = target
+        return target
+
+    def run_batch(self, state, words):
+        """
+        Step every word (a sequence of symbols) from state and return the final state
+        of each. The words are put in a trie first, so a prefix shared by several
+        words is stepped only once.
+        """
+        # A trie node is [children by symbol, state reached]
+        root = [{}, state]
+        ends = []
+        for word in words:
+            node = root
+            for symbol in word:
+                children = node[0]
+                child = children.get(symbol)
+                if child is None:
+                    child = children[symbol] = [{}, 0]
+                node = child
+            ends.append(node)
+        stack = [root]
+        while stack:
+            children, current = stack.pop()
+            for symbol, child in children.items():
+                # Nothing can be read after a dead (empty) state
+                child[1] = self.step(current, symbol) if current else 0
+                stack.append(child)
+        return [node[1] for node in ends]
+
+    def reachable(self, start, max_states):
+        """
+        Breadth-first search from start, symbols in sorted order. Returns (states in
+        discovery order, shortest path to each, one {symbol: state index} dict per state,
+        whether max_states was hit).
+        """
+        index = {start: 0}
+        order = [start]
+        paths = [[]]
+        transitions = []
+        truncated = False
+        queue = deque([0])
+        while queue:
+            source = queue.popleft()
+            edges = {}
+            for symbol in sorted(self.describe(order[source])[2]):
+                target = self.step(order[source], symbol)
+                if target not in index:
+                    if len(order) >= max_states:
+                        truncated = True
                         continue
-                    else:
-                        result_expression = self._back_coma_to_start(result_expression, i)
-                        i += 1
-                        while i < len(self.expression) and self.expression[i] == '}':
-                            result_expression += self.expression[i]
-                            i += 1
-                        result_expression += '.'
+                    index[target] = len(order)
+                    order.append(target)
+                    paths.append(paths[source] + [symbol])
+                    queue.append(index[target])
+                edges[symbol] = index[target]
+            transitions.append(edges)
+        return order, paths, transitions, truncated
+
+    def minimize(self, order, transitions):
+        """
+        Hopcroft's algorithm over a completely explored automaton (as returned by
+        reachable, order[0] the start). Returns the number of each state in the minimal
+        automaton. Numbers are canonical: the minimal automaton is numbered breadth-first
+        from the start with symbols in sorted order, so equal languages get equal numbers
+        whatever the shape of the regex.
+        """
+        count = len(order)
+        sink = count  # the dead state every missing transition goes to
+        alphabet = sorted({symbol for edges in transitions for symbol in edges})
+        inverse = {symbol: {} for symbol in alphabet}
+        for source, edges in enumerate(transitions):
+            for symbol in alphabet:
+                inverse[symbol].setdefault(edges.get(symbol, sink), []).append(source)
+        for symbol in alphabet:
+            inverse[symbol].setdefault(sink, []).append(sink)
+
+        accepting = {i for i, state in enumerate(order) if state & self.end_mask}
+        blocks = [block for block in (accepting, set(range(count + 1)) - accepting) if block]
+        block_of = [0] * (count + 1)
+        for number, block in enumerate(blocks):
+            for i in block:
+                block_of[i] = number
+        pending = list(range(len(blocks)))
+        queued = set(pending)
+        while pending:
+            splitter = pending.pop()
+            queued.discard(splitter)
+            members = list(blocks[splitter])
+            for symbol in alphabet:
+                predecessors = {}
+                for target in members:
+                    for source in inverse[symbol].get(target, ()):
+                        predecessors.setdefault(block_of[source], set()).add(source)
+                for number, part in predecessors.items():
+                    if len(part) == len(blocks[number]):
                         continue
-                if self.expression[i] == '.' and self.expression[i + 1] == '|':
-                    result_expression = self._parse_alternative(result_expression, i)
-                    i = 0
-                    self.expression = result_expression
-                    result_expression = ""
-                    continue
-                if self.expression[i + 1] in "([{":
-                    self.in_brackets += 1
-                    char_start = self.expression[i + 1]
-                    char_end = ']' if char_start == '[' else (')' if char_start == '(' else '}')
-                    if char_end in "]}":
-                        dot_after_scope += 1
-                    add_dot = True
-                    i += 1
-                    in_brackets = -1
-                    while i < len(self.expression):
-                        result_expression += self.expression[i]
-                        if add_dot:
-                            result_expression += '.'
-                            add_dot = False
-                        if self.expression[i] in "([{":
-                            in_brackets += 1
-                        elif self.expression[i] in ")]}":
-                            in_brackets -= 1
-                        elif self.expression[i] == '|' and in_brackets == 0:
-                            result_expression += '.'
-                        if (i + 1 < len(self.expression) and self.expression[i + 1] == char_end) and in_brackets == 0:
-                            i += 1
-                            break
-                        i += 1
-                    continue
-                else:
-                    result_expression += self.expression[i]
-                    i += 1
-            elif self.expression[i] in ")]}":
-                if dot_after_scope > 0:
-                    result_expression += self.expression[i] + '.'
-                    dot_after_scope -= 1
+                    blocks[number] -= part
+                    blocks.append(part)
+                    new = len(blocks) - 1
+                    for i in part:
+                        block_of[i] = new
+                    if number in queued:
+                        pending.append(new)
+                        queued.add(new)
+                    else:
+                        # Only the smaller half needs to be used as a splitter
+                        smaller = new if len(part) <= len(blocks[number]) else number
+                        pending.append(smaller)
+                        queued.add(smaller)
+
+        # Canonical numbering: breadth-first over the minimal automaton, symbols sorted
+        numbers = {block_of[0]: 0}
+        queue = deque([0])
+        while queue:
+            state = queue.popleft()
+            for symbol in sorted(transitions[state]):
+                target = transitions[state][symbol]
+                if block_of[target] not in numbers:
+                    numbers[block_of[target]] = len(numbers)
+                    queue.append(target)
+        return [numbers[block_of[i]] for i in range(count)]
+
+    def canonical_numbers(self, max_states=CANONICAL_MAX_STATES):
+        """
+        Return {state: canonical number} for every state reachable from the initial
+        state, or None if there are more than max_states of them. Computed once per automaton.
+        """
+        if self._canonical is None or self._canonical[0] != max_states:
+            order, _, transitions, truncated = self.reachable(self.initial, max_states)
+            numbers = None if truncated else dict(zip(order, self.minimize(order, transitions)))
+            self._canonical = (max_states, numbers)
+        return self._canonical[1]
+
+    def describe(self, state):
+        """
+        Return (dotted expression, highlight ids, symbols after a dot) for a state.
+        """
+        info = self.states.get(state)
+        if info is None:
+            source = self.expression
+            pieces = []
+            ids = []
+            last = 0
+            for k in bits(state):
+                if k == self.end:
+                    gap = self.length
+                    ids.append(END_MARKER_ID)
                 else:
-                    result_expression += self.expression[i]
-                i += 1
-            else:
-                result_expression += self.expression[i]
-                i += 1
+                    gap = self.terminals[k].start
+                    ids.append(self.list_id[k])
+                pieces.append(source[last:gap])
+                pieces.append(".")
+                last = gap
+            pieces.append(source[last:])
+            symbols = frozenset(symbol for symbol, mask in self.symbol_masks.items() if state & mask)
+            info = ("".join(pieces), tuple(ids), symbols)
+            self.states[state] = info
+        return info
+
+
+@lru_cache(maxsize=256)
+def _compile(expression, list_id):
+    return PositionAutomaton(expression, list_id)
 
-        return self._remove_duplicate_dots(result_expression)
+
+def compile_expression(expression, list_id):
+    """
+    Return the (shared) compiled automaton for an expression and its terminal ids.
+    """
+    return _compile(expression.replace(".", ""), tuple(list_id))
+
+
+class ExpressionParser:
+    """
+    A parser for stepping through a regular expression by moving dots ('.')
+    over its terminals, handling brackets, alternatives, and scopes.
+    """
+
+    def __init__(self, expression, list_id):
+        """
+        Initialize the ExpressionParser with a given expression.
+        Dots already present in the expression are kept as part of the initial state.
+        """
+        self.automaton = compile_expression(expression, list_id)
+        self.list_id = list_id
+        if '.' not in expression:
+            self.state = self.automaton.initial
+            return
+        gaps = self.automaton.start_gaps()
+        offset = 0
+        for i, char in enumerate(expression):
+            if char == '.':
+                gaps.append(i - offset)
+                offset += 1
+        self.state = self.automaton.closure(gaps)
+
+    @property
+    def expression(self):
+        return self.automaton.describe(self.state)[0]
 
     def unique_chars_after_dot(self):
-        unique_chars = set()
-        for i in range(len(self.expression) - 1):
-            if self.expression[i] == '.':
-                unique_chars.add(self.expression[i + 1])
-        return unique_chars
+        return self.automaton.describe(self.state)[2]
 
     def get_expression(self):
         """
         Retrieve the current state of the expression.
         """
-        return self.expression
+        return self.automaton.describe(self.state)[0]
 
     def get_ids(self):
-        needed_ids = []
-        i = 0
-        y = 0
-        while i < len(self.expression):
-            if self.expression[i] in "{[(|)]}":
-                i += 1
-                continue
-            if self.expression[i] == '.' and i != len(self.expression) - 1:
-                needed_ids.append(self.list_id[y])
-                i += 2
-                y += 1
-            elif self.expression[i] == '.' and i == len(self.expression) - 1:
-                needed_ids.append(100)
-                i += 1
-            else:
-                i += 1
-                y += 1
-        return needed_ids
+        return list(self.automaton.describe(self.state)[1])
+
+    def get_state(self):
+        """
+        Retrieve the current state as a compact bitset (an int) of the terminals
+        with a dot in front of them; it can be stored in a session or cache and restored.
+        """
+        return self.state
+
+    def set_state(self, mask):
+        """
+        Restore a state previously returned by get_state.
+        """
+        self.state = int(mask) & ((self.automaton.end_mask << 1) - 1)
 
     def do_cycle(self, symbol):
         """Move dots after symbol and updates their placement. Returns symbol id if its after dot"""
 
-        self.move_all(symbol)
-        self.update_comas()
+        self.state = self.automaton.step(self.state, symbol)
         return self.get_ids()
 
+    def replay_batch(self, words):
+        """
+        Run several words from the current state without changing it.
+        Returns (highlight ids, available symbols, accepted) for each word; a word is
+        accepted when the dot reaches the end of the expression (highlight id END_MARKER_ID).
+        """
+        automaton = self.automaton
+        results = []
+        for state in automaton.run_batch(self.state, words):
+            _, ids, symbols = automaton.describe(state)
+            results.append((list(ids), symbols, bool(state & automaton.end_mask)))
+        return results
+
+    def explore(self, max_states=1000, minimize=False):
+        """
+        Breadth-first search over every state reachable from the current one.
+
+        Returns a dict with the states in discovery order (dotted expression, highlight
+        ids, available symbols and the shortest path of symbols leading there), the
+        transition table {state index: {symbol: state index}} and whether the search
+        stopped at max_states. State 0 is the current state.
+
+        With minimize=True (and a complete search) equivalent states are merged: each
+        state of the result is a state of the minimal automaton, numbered canonically,
+        described by its first discovered member and listing every member's expression.
+        """
+        automaton = self.automaton
+        order, paths, transitions, truncated = automaton.reachable(self.state, max_states)
+        described = [automaton.describe(state) for state in order]
+        if not minimize or truncated:
+            states = []
+            for (expression, ids, symbols), path in zip(described, paths):
+                states.append({
+                    "expression": expression,
+                    "highlight_ids": list(ids),
+                    "available_symbols": sorted(symbols),
+                    "path": path,
+                })
+            return {"states": states, "transitions": transitions, "truncated": truncated, "minimized": False}
+
+        numbers = automaton.minimize(order, transitions)
+        count = max(numbers) + 1
+        states = [None] * count
+        minimal_transitions = [None] * count
+        for i, number in enumerate(numbers):
+            expression, ids, symbols = described[i]
+            if states[number] is None:
+                # Discovery order is breadth-first, so the first member has the shortest path
+                states[number] = {
+                    "expression": expression,
+                    "highlight_ids": list(ids),
+                    "available_symbols": sorted(symbols),
+                    "path": paths[i],
+                    "members": [],
+                }
+                minimal_transitions[number] = {symbol: numbers[target] for symbol, target in transitions[i].items()}
+            states[number]["members"].append(expression)
+        return {"states": states, "transitions": minimal_transitions, "truncated": False, "minimized": True}
+
+    def state_number(self, max_states=CANONICAL_MAX_STATES):
+        """
+        Return the canonical number of the current state in the minimal automaton
+        (0 for the initial state), or None if the automaton has more than max_states states.
+        """
+        numbers = self.automaton.canonical_numbers(max_states)
+        return None if numbers is None else numbers.get(self.state)
+
+
+def exploration_to_dot(exploration):
+    """
+    Render the result of ExpressionParser.explore as a GraphViz digraph (states are q0, q1, ...).
+    """
+    lines = ["digraph {", "rankdir=LR;"]
+    for source, edges in enumerate(exploration["transitions"]):
+        for symbol, target in edges.items():
+            lines.append(f'  q{source} -> q{target} [label="{symbol}"];')
+    lines.append("}")
+    return "\n".join(lines)
+
+
+class Matcher:
+    """
+    Checks whole words against a regex with its compiled automaton: one memoized
+    step per symbol, so a word is checked in time linear in its length.
+    """
+
+    def __init__(self, expression):
+        self.automaton = compile_expression(expression, terminal_ids(expression))
+
+    def match(self, word):
+        """
+        Return the MatchResult of a word (a string or a sequence of symbols).
+        """
+        automaton = self.automaton
+        state = automaton.initial
+        for position, symbol in enumerate(word):
+            state = automaton.step(state, symbol)
+            if not state:
+                return MatchResult(False, position)
+        if state & automaton.end_mask:
+            return MatchResult(True, None)
+        return MatchResult(False, len(word))
+
+    def match_lines(self, lines):
+        """
+        Lazily match an iterable of lines (e.g. an open file), one word per line.
+        """
+        for line in lines:
+            yield self.match(line.rstrip("\r\n"))
+
+
+@lru_cache(maxsize=256)
+def compile_matcher(expression):
+    return Matcher(expression)
+
+
+def match_word(expression, word):
+    """
+    Check a single word against expression, e.g. match_word("(a|b){c}d", "acd").
+    """
+    return compile_matcher(expression).match(word)
+
 
 if __name__ == '__main__':
     parser = ExpressionParser("abc",
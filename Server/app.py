@@ -1,12 +1,24 @@
 import os
 import uuid
-import time
+import hashlib
+import hmac
+import gzip
+import json
 import logging
 from logging.handlers import TimedRotatingFileHandler
-from flask import Flask, request, jsonify, session
-from graphviz import Source
-from RegexAlgorithm import ExpressionParser
-from diagramGenerator import generate_svg_from_regex
+from flask import Flask, Response, request, jsonify, session, stream_with_context
+from RegexAlgorithm import ExpressionParser, compile_matcher, exploration_to_dot
+from diagramGenerator import terminal_ids
+from railroadBib import DEFAULT_STYLE
+from cache import LRUCache, make_cache
+from janitor import DiagramJanitor
+from renderer import GraphRenderer, RenderQueueFull, RenderTimeout
+from stategraph import StateGraph
+from concurrency import ConcurrencyLimiter
+from layout import LayoutPool, LayoutQueueFull, LayoutTimeout
+from statestore import MemoryStateStore, SqliteStateStore
+from metrics import Metrics
+from profiler import ProfilerBusy, ProfilerRateLimited, RequestProfiler, current_profile
 
 # Create logs folder if it doesn't exist
 if not os.path.exists("logs"):
@@ -26,65 +38,248 @@ app.secret_key = os.urandom(32)
 OUTPUT_DIR = "static/diagrams"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-def cleanup_diagrams(max_age_days=1):
+# Stage latency histograms and cache/queue gauges, served at /metrics when METRICS_ENABLED=1
+METRICS = Metrics(enabled=os.environ.get("METRICS_ENABLED", "") not in ("", "0"))
+
+# Expires diagram files unused for a day from a background thread
+JANITOR = DiagramJanitor(OUTPUT_DIR, max_age_seconds=86400, interval=300, batch_size=100,
+                         observe=METRICS.observe)
+JANITOR.start()
+
+# Parser states addressed by handles; the session cookie only holds the current handle.
+# Set STATE_STORE_PATH to keep them in sqlite (shared between processes, kept across restarts).
+STATE_STORE_PATH = os.environ.get("STATE_STORE_PATH")
+STATE_STORE = SqliteStateStore(STATE_STORE_PATH) if STATE_STORE_PATH else MemoryStateStore()
+
+# Backend of the caches below: in-process by default, "sqlite:///path/cache.db" to share
+# them between the workers of a node or "redis://host:port/db" to share them between nodes
+CACHE_URL = os.environ.get("CACHE_URL")
+
+# Parser states (bitsets) keyed by (regex, hash of the transitions applied so far)
+STATE_CACHE_SIZE = 4096
+STATE_CACHE = make_cache(CACHE_URL, "states", STATE_CACHE_SIZE)
+
+# Concurrency limits of the heavy endpoints. Together they stay below the number of
+# server threads (see the Dockerfile) so transition calls never wait behind them.
+DIAGRAM_LIMIT = ConcurrencyLimiter("diagram", 4)
+GRAPH_LIMIT = ConcurrencyLimiter("graph render", 2)
+BATCH_LIMIT = ConcurrencyLimiter("batch", 4)
+
+# Diagram layout runs in worker processes, each job with a 5 s deadline
+LAYOUT_POOL = LayoutPool(max_workers=2, max_queue=8, timeout=5, observe=METRICS.observe)
+
+# State graphs rendered by GraphViz, cached by the hash of the canonical DOT text
+GRAPH_RENDERER = GraphRenderer(max_workers=2, max_queue=32, timeout=10, cache=make_cache(CACHE_URL, "graphs", 256),
+                               observe=METRICS.observe)
+
+# Incrementally laid out state graphs, one per session (session["graph_id"]); these are live
+# objects, so they always stay in the process
+GRAPH_SESSIONS = LRUCache(maxsize=1024)
+
+# Limits for /replay-batch
+MAX_BATCH_WORDS = 1000
+MAX_BATCH_SYMBOLS = 100000
+
+# Upper bound for /explore-states (clients may ask for fewer)
+MAX_EXPLORED_STATES = 5000
+
+# On-demand profiling of live requests (see /admin/profile), only available when
+# PROFILE_TOKEN is set; profiles are written to PROFILE_DIR
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILER = RequestProfiler(os.environ.get("PROFILE_DIR", "logs/profiles"), min_interval=60)
+
+
+def layout_profile_path():
+    """
+    Where the layout worker writes its profile when the current request is being profiled.
     """
-    Delete diagram files in the static/diagrams folder that are older than max_age_days.
+    prefix = current_profile.get()
+    return None if prefix is None else prefix + ".layout.prof"
+
+
+def history_hash(previous, symbol):
     """
-    diagrams_folder = os.path.join(os.getcwd(), "static", "diagrams")
-    now = time.time()
-    max_age_seconds = max_age_days * 86400  # seconds in a day
-    for filename in os.listdir(diagrams_folder):
-        file_path = os.path.join(diagrams_folder, filename)
-        if os.path.isfile(file_path):
-            file_age = now - os.path.getmtime(file_path)
-            if file_age > max_age_seconds:
-                try:
-                    os.remove(file_path)
-                    logging.info("Removed old diagram: %s", file_path)
-                except Exception as e:
-                    logging.error("Error removing file %s: %s", file_path, e)
+    Extend the hash of a transition prefix by one symbol.
+    """
+    return hashlib.sha1(f"{previous}\x00{symbol}".encode("utf-8")).hexdigest()
+
+
+def new_parser(regex, id_list):
+    """
+    Create an ExpressionParser, timing its construction.
+    """
+    with METRICS.timer("parser_init"):
+        return ExpressionParser(regex, id_list)
+
+
+def restore_parser(regex, id_list, transitions):
+    """
+    Return (parser, history hash) positioned after the given transitions.
+    Starts from the longest prefix whose state is cached and caches every new step.
+    """
+    hashes = [""]
+    for symbol in transitions:
+        hashes.append(history_hash(hashes[-1], symbol))
+    parser = new_parser(regex, id_list)
+    depth = len(transitions)
+    while depth > 0:
+        state = STATE_CACHE.get((regex, hashes[depth]))
+        if state is not None:
+            parser.set_state(state)
+            break
+        depth -= 1
+    METRICS.observe_replay(len(transitions) - depth)
+    with METRICS.timer("replay"):
+        for i in range(depth, len(transitions)):
+            parser.do_cycle(transitions[i])
+            STATE_CACHE.put((regex, hashes[i + 1]), parser.get_state())
+    return parser, hashes[-1]
+
+
+def remove_diagram(key, entry):
+    """
+    Hand the file of a diagram evicted from DIAGRAM_CACHE over to the janitor.
+    """
+    JANITOR.discard(entry[0])
+
+
+# Rendered diagrams keyed by a hash of the normalized regex and the style: key -> (filename, id_list)
+DIAGRAM_CACHE_SIZE = 512
+DIAGRAM_CACHE = make_cache(CACHE_URL, "diagrams", DIAGRAM_CACHE_SIZE, on_evict=remove_diagram)
+
+
+def diagram_key(regex, css=None):
+    """
+    Hash identifying the diagram of a normalized regex drawn with a given stylesheet.
+    """
+    style = DEFAULT_STYLE if css is None else css
+    return hashlib.sha256(f"{regex}\x00{style}".encode("utf-8")).hexdigest()
+
+
+async def get_diagram(regex, css=None):
+    """
+    Return (filename, id_list) of the diagram for regex, rendering it in the layout
+    pool only if it is not cached yet. Files are named after a hash of their content.
+    """
+    key = diagram_key(regex, css)
+    entry = DIAGRAM_CACHE.get(key)
+    if entry is not None:
+        if os.path.exists(os.path.join(OUTPUT_DIR, entry[0])):
+            JANITOR.touch(entry[0])
+            return entry
+    # May raise RegexSyntaxError with a detailed error message, or LayoutQueueFull / LayoutTimeout
+    svg, id_list = await LAYOUT_POOL.render_async(regex, css, profile_path=layout_profile_path())
+    filename = f"diagram_{hashlib.sha256(svg.encode('utf-8')).hexdigest()}.svg"
+    output_file = os.path.join(OUTPUT_DIR, filename)
+    if not os.path.exists(output_file):
+        with METRICS.timer("disk_write"):
+            tmp_file = os.path.join(OUTPUT_DIR, f".{uuid.uuid4().hex}.tmp")
+            with open(tmp_file, "w") as f:
+                f.write(svg)
+            os.replace(tmp_file, output_file)
+    JANITOR.register(filename, len(svg.encode("utf-8")))
+    entry = (filename, id_list)
+    DIAGRAM_CACHE.put(key, entry)
+    return entry
+
+
+# Markup of diagrams returned inline (no file on disk): key -> (svg, id_list)
+INLINE_CACHE_SIZE = 128
+INLINE_CACHE = make_cache(CACHE_URL, "inline", INLINE_CACHE_SIZE)
+
+
+async def get_inline_diagram(regex, css=None):
+    """
+    Return (svg markup, id_list) of the diagram for regex, rendered in the layout pool.
+    """
+    key = diagram_key(regex, css)
+    entry = INLINE_CACHE.get(key)
+    if entry is None:
+        entry = await LAYOUT_POOL.render_async(regex, css, profile_path=layout_profile_path())
+        INLINE_CACHE.put(key, entry)
+    return entry
+
+
+# Responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+
+def compressed_json(payload):
+    """
+    jsonify payload and gzip the body if the client accepts it.
+    """
+    response = jsonify(payload)
+    accept_encoding = request.headers.get("Accept-Encoding", "")
+    if "gzip" in accept_encoding and len(response.get_data()) >= GZIP_MIN_SIZE:
+        response.set_data(gzip.compress(response.get_data()))
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+def load_state(handle=None):
+    """
+    Return (regex, id_list, state) for handle, by default the session's current state, or None.
+    """
+    if handle is None:
+        handle = session.get("state_handle")
+    return STATE_STORE.get(handle) if handle is not None else None
+
+
+def state_response(parser, handle, expression_key="updated_regex"):
+    """
+    The JSON fields describing the parser's current state.
+    """
+    return {
+        "highlight_ids": parser.get_ids(),
+        expression_key: parser.get_expression(),
+        "available_symbols": list(parser.unique_chars_after_dot()),
+        "state_handle": handle,
+        # Equivalent states share this number (null for very large automata)
+        "state_number": parser.state_number(),
+    }
+
 
 @app.route('/')
 def index():
     return app.send_static_file('index.html')
 
 @app.route('/generate-regex', methods=['POST'])
-def generate_regex():
+@DIAGRAM_LIMIT
+async def generate_regex():
     """
-    Accepts {"diagram_data": "..."}.
-    Generates the diagram, creates the parser, and saves the processed initial state (with dots)
-    in the session so that each user has their own isolated state.
-    Also cleans up old diagram files.
+    Accepts {"diagram_data": "...", "inline": false}.
+    Generates the diagram, creates the parser, and stores its initial state in the state store;
+    the session only keeps the handle of the current state ("state_handle", also returned).
+    With "inline": true the SVG markup is returned in the response ("svg") instead of
+    being written to static/diagrams ("diagram_url").
+    Answers 503 when the layout queue is full and 504 when the layout misses its deadline.
     """
     try:
-        data = request.json.get('diagram_data', '')
+        data = request.json.get('diagram_data', '').strip()
         if not data:
             return jsonify({"error": "No diagram data provided"}), 400
+        inline = bool(request.json.get('inline', False))
+
+        if inline:
+            svg, id_list = await get_inline_diagram(data)
+        else:
+            filename, id_list = await get_diagram(data)
+
+        parser = new_parser(data, id_list)
+        handle = STATE_STORE.put(data, id_list, parser.get_state())
+        session["state_handle"] = handle
 
-        # Cleanup old diagram files (older than 1 day)
-        cleanup_diagrams(max_age_days=1)
-
-        filename = f"diagram_{uuid.uuid4().hex}.svg"
-        output_file = os.path.join(OUTPUT_DIR, filename)
-        # generate_svg_from_regex may raise an exception with a detailed error message
-        id_list = generate_svg_from_regex(data, output_file=output_file)
-
-        parser = ExpressionParser(data, id_list)
-        current_expression = parser.get_expression()
-        needed_ids = parser.get_ids()
-        available_symbols = list(parser.unique_chars_after_dot())
-
-        # Save initial state and transitions in session
-        session["initial_expression"] = current_expression
-        session["initial_id_list"] = id_list
-        session["transitions_history"] = []
-
-        return jsonify({
-            "diagram_url": f"/static/diagrams/{filename}",
-            "highlight_ids": needed_ids,
-            "available_symbols": available_symbols,
-            "initial_regex": current_expression
-        })
+        result = state_response(parser, handle, "initial_regex")
+        if inline:
+            result["svg"] = svg
+            return compressed_json(result)
+        result["diagram_url"] = f"/static/diagrams/{filename}"
+        return jsonify(result)
+    except LayoutQueueFull as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+    except LayoutTimeout as e:
+        logging.error(e)
+        return jsonify({"error": str(e)}), 504
     except Exception as e:
         logging.error(e)
         return jsonify({"error": str(e)}), 500
@@ -92,42 +287,50 @@ def generate_regex():
 @app.route('/generate-transition', methods=['POST'])
 def generate_transition():
     """
-    Accepts {"transition": "symbol"}.
-    Applies a new transition using the session's stored state, updates it, and returns the new state.
+    Accepts {"transition": "symbol", "state_handle": optional}.
+    Applies a new transition to the given state (by default the session's current state),
+    makes the result the session's current state and returns it with its handle.
     """
     try:
         symbol = request.json.get('transition', '')
         if not symbol:
             return jsonify({"error": "No transition provided"}), 400
 
-        # Retrieve state from session
-        initial_expression = session.get("initial_expression")
-        initial_id_list = session.get("initial_id_list")
-        transitions_history = session.get("transitions_history", [])
-
-        if initial_expression is None or initial_id_list is None:
+        record = load_state(request.json.get("state_handle"))
+        if record is None:
             return jsonify({"error": "Session state not found."}), 400
+        regex, id_list, state = record
 
-        # Recreate the parser from the initial state and apply previous transitions
-        parser = ExpressionParser(initial_expression, initial_id_list)
-        for t in transitions_history:
-            parser.do_cycle(t)
+        # The automaton is compiled once per regex, so restoring the state is a lookup
+        parser = new_parser(regex, id_list)
+        parser.set_state(state)
         # Apply the new transition
-        transitions_history.append(symbol)
         parser.do_cycle(symbol)
 
-        current_expression = parser.get_expression()
-        needed_ids = parser.get_ids()
-        available_symbols = list(parser.unique_chars_after_dot())
-
-        # Update session state
-        session["transitions_history"] = transitions_history
+        handle = STATE_STORE.put(regex, id_list, parser.get_state())
+        session["state_handle"] = handle
+        return jsonify(state_response(parser, handle))
+    except Exception as e:
+        logging.error(e)
+        return jsonify({"error": str(e)}), 500
 
-        return jsonify({
-            "highlight_ids": needed_ids,
-            "updated_regex": current_expression,
-            "available_symbols": available_symbols
-        })
+@app.route('/jump-to-state', methods=['POST'])
+def jump_to_state():
+    """
+    Accepts {"state_handle": "..."}.
+    Makes a previously returned state the session's current state (a lookup, nothing is
+    replayed) and returns it.
+    """
+    try:
+        handle = request.json.get("state_handle")
+        record = load_state(handle) if handle else None
+        if record is None:
+            return jsonify({"error": "Unknown or expired state."}), 404
+        regex, id_list, state = record
+        parser = new_parser(regex, id_list)
+        parser.set_state(state)
+        session["state_handle"] = handle
+        return jsonify(state_response(parser, handle))
     except Exception as e:
         logging.error(e)
         return jsonify({"error": str(e)}), 500
@@ -141,50 +344,327 @@ def replay():
     """
     try:
         path = request.json.get('path', [])
-        initial_expression = session.get("initial_expression")
-        initial_id_list = session.get("initial_id_list")
+        record = load_state()
+        if record is None:
+            return jsonify({"error": "Session state not found."}), 400
+        regex, id_list, _ = record
+
+        parser, _ = restore_parser(regex, id_list, list(path))
+        handle = STATE_STORE.put(regex, id_list, parser.get_state())
+        session["state_handle"] = handle
+        return jsonify(state_response(parser, handle))
+    except Exception as e:
+        logging.error(e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/replay-batch', methods=['POST'])
+@BATCH_LIMIT
+def replay_batch():
+    """
+    Accepts {"regex": "...", "words": ["abc", ["a", "b"], ...]}.
+    Runs every word from the initial state of regex (the session's regex if omitted)
+    and returns, in the same order, the final "highlight_ids", "available_symbols"
+    and whether the word is "accepted" (the end marker 100 is reached).
+    The session state is not changed.
+    """
+    try:
+        words = request.json.get("words", [])
+        if not isinstance(words, list) or not all(
+                isinstance(word, str) or (isinstance(word, list) and all(isinstance(s, str) for s in word))
+                for word in words):
+            return jsonify({"error": "words must be a list of strings or lists of symbols"}), 400
+        if len(words) > MAX_BATCH_WORDS or sum(len(word) for word in words) > MAX_BATCH_SYMBOLS:
+            return jsonify({"error": f"At most {MAX_BATCH_WORDS} words and {MAX_BATCH_SYMBOLS} symbols "
+                                     f"per request"}), 400
+
+        regex = request.json.get("regex")
+        if regex is not None:
+            regex = str(regex).strip()
+            if not regex:
+                return jsonify({"error": "No regex provided"}), 400
+            id_list = terminal_ids(regex)
+        else:
+            record = load_state()
+            if record is None:
+                return jsonify({"error": "Session state not found."}), 400
+            regex, id_list, _ = record
+
+        parser = new_parser(regex, id_list)
+        for word in words:
+            METRICS.observe_replay(len(word))
+        with METRICS.timer("replay_batch"):
+            results = [
+                {"highlight_ids": ids, "available_symbols": sorted(symbols), "accepted": accepted}
+                for ids, symbols, accepted in parser.replay_batch(words)
+            ]
+        return compressed_json({"results": results})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/match', methods=['POST'])
+@BATCH_LIMIT
+def match():
+    """
+    Checks whole words against a regex: accept/reject and the first failing position
+    (the index of the first symbol that cannot be read, or the word length if the word
+    stops before the end; null when accepted).
+
+    A JSON body {"regex": "...", "words": [...]} returns {"results": [{"accepted", "position"}]}.
+    Any other body is read as a word list, one word per line, with the regex in the query
+    string (POST /match?regex=...), and answered with one JSON line per word as the body
+    is read, followed by a summary line, so large word lists are never held in memory.
+    """
+    try:
+        if request.is_json:
+            regex = str(request.json.get("regex", "")).strip()
+            words = request.json.get("words", [])
+            if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+                return jsonify({"error": "words must be a list of strings"}), 400
+            if len(words) > MAX_BATCH_WORDS:
+                return jsonify({"error": f"At most {MAX_BATCH_WORDS} words per request"}), 400
+        else:
+            regex = request.args.get("regex", "").strip()
+        if not regex:
+            return jsonify({"error": "No regex provided"}), 400
+        matcher = compile_matcher(regex)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(e)
+        return jsonify({"error": str(e)}), 500
+
+    if request.is_json:
+        results = [{"accepted": result.accepted, "position": result.position}
+                   for result in map(matcher.match, words)]
+        return compressed_json({"results": results})
+
+    def stream():
+        total = accepted = 0
+        lines = (line.decode("utf-8", "replace") for line in request.stream)
+        for total, result in enumerate(matcher.match_lines(lines), 1):
+            accepted += result.accepted
+            yield json.dumps({"line": total, "accepted": result.accepted, "position": result.position}) + "\n"
+        yield json.dumps({"total": total, "accepted": accepted, "rejected": total - accepted}) + "\n"
+
+    return Response(stream_with_context(stream()), mimetype="application/x-ndjson")
 
-        if initial_expression is None or initial_id_list is None:
+@app.route('/explore-states', methods=['POST'])
+@BATCH_LIMIT
+def explore_states():
+    """
+    Accepts {"max_states": 1000, "dot": false, "minimize": false}.
+    Explores every state reachable from the initial state of the session's regex and returns
+    them all at once: "states" (q0, q1, ... in BFS order, each with its expression, highlight
+    ids, available symbols and a path for /replay), "transitions" ({"q0": {"a": "q1"}}),
+    "truncated" if max_states was hit, and "dot" (the GraphViz source) when requested.
+    With "minimize": true equivalent states are merged into the states of the minimal
+    automaton, numbered canonically (the numbers match "state_number" of the other
+    endpoints) and listing their "members"; "minimized" tells whether that was possible.
+    """
+    try:
+        record = load_state()
+        if record is None:
             return jsonify({"error": "Session state not found."}), 400
+        regex, initial_id_list, _ = record
+        try:
+            max_states = int(request.json.get("max_states", MAX_EXPLORED_STATES))
+        except (TypeError, ValueError):
+            return jsonify({"error": "max_states must be an integer"}), 400
+        max_states = max(1, min(max_states, MAX_EXPLORED_STATES))
 
-        parser = ExpressionParser(initial_expression, initial_id_list)
-        transitions_history = []
-        for sym in path:
-            transitions_history.append(sym)
-            parser.do_cycle(sym)
+        minimize = bool(request.json.get("minimize", False))
+        exploration = new_parser(regex, initial_id_list).explore(max_states, minimize)
+        states = {}
+        for i, state in enumerate(exploration["states"]):
+            states[f"q{i}"] = state
+        transitions = {}
+        for i, edges in enumerate(exploration["transitions"]):
+            transitions[f"q{i}"] = {symbol: f"q{target}" for symbol, target in edges.items()}
 
-        current_expression = parser.get_expression()
-        needed_ids = parser.get_ids()
-        available_symbols = list(parser.unique_chars_after_dot())
+        result = {
+            "initial_state": "q0",
+            "states": states,
+            "transitions": transitions,
+            "truncated": exploration["truncated"],
+            "minimized": exploration["minimized"],
+        }
+        if request.json.get("dot", False):
+            result["dot"] = exploration_to_dot(exploration)
+        return compressed_json(result)
+    except Exception as e:
+        logging.error(e)
+        return jsonify({"error": str(e)}), 500
 
-        # Update session state
-        session["transitions_history"] = transitions_history
+@app.route('/graph-delta', methods=['POST'])
+def graph_delta():
+    """
+    Accepts {"nodes": ["q0"], "edges": [["q0", "a", "q1"], ...], "reset": false, "full": false}.
+    Adds the states and edges to the session's state graph and returns only what changed:
+    "nodes" (coordinates of the new states), "patch" (SVG of each new or relabelled element,
+    with its element id and group) and the new "width"/"height". The complete SVG is returned
+    as "svg" when the graph is (re)created or "full" is requested; "created" tells a client
+    that did not ask for a reset that its graph expired and should be sent again.
+    """
+    try:
+        nodes = request.json.get("nodes", [])
+        edges = request.json.get("edges", [])
+        if not isinstance(nodes, list) or not all(isinstance(name, str) for name in nodes):
+            return jsonify({"error": "nodes must be a list of state names"}), 400
+        if not isinstance(edges, list) or not all(
+                isinstance(edge, list) and len(edge) == 3 and all(isinstance(part, str) for part in edge)
+                for edge in edges):
+            return jsonify({"error": "edges must be a list of [source, symbol, target]"}), 400
+
+        graph_id = session.get("graph_id")
+        graph = GRAPH_SESSIONS.get(graph_id) if graph_id is not None else None
+        full = bool(request.json.get("full", False))
+        reset = bool(request.json.get("reset", False))
+        created = graph is None and not reset
+        if graph is None or reset:
+            graph = StateGraph()
+            graph_id = uuid.uuid4().hex
+            session["graph_id"] = graph_id
+            GRAPH_SESSIONS.put(graph_id, graph)
+            full = True
 
-        return jsonify({
-            "highlight_ids": needed_ids,
-            "updated_regex": current_expression,
-            "available_symbols": available_symbols
-        })
+        try:
+            result = graph.apply(nodes, edges)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if full:
+            result["svg"] = graph.to_svg()
+        result["created"] = created
+        return compressed_json(result)
     except Exception as e:
         logging.error(e)
         return jsonify({"error": str(e)}), 500
 
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """
+    Returns the backend, size, hit ratio and average get/put latency of every cache.
+    """
+    return jsonify({
+        "diagrams": DIAGRAM_CACHE.stats(),
+        "inline": INLINE_CACHE.stats(),
+        "states": STATE_CACHE.stats(),
+        "graphs": GRAPH_RENDERER.cache.stats(),
+        "graph_sessions": GRAPH_SESSIONS.stats(),
+    })
+
+def metric_gauges():
+    """
+    Gauges of the caches, queues and concurrency limits, read from their stats().
+    """
+    caches = {"diagrams": DIAGRAM_CACHE, "inline": INLINE_CACHE, "states": STATE_CACHE,
+              "graphs": GRAPH_RENDERER.cache, "graph_sessions": GRAPH_SESSIONS}
+    for name, cache in caches.items():
+        stats = cache.stats()
+        labels = {"cache": name, "backend": stats["backend"]}
+        yield "cache_entries", "Entries in the cache.", labels, stats["size"]
+        yield "cache_max_entries", "Capacity of the cache.", labels, stats["maxsize"]
+        yield "cache_hits", "Cache hits since start.", labels, stats["hits"]
+        yield "cache_misses", "Cache misses since start.", labels, stats["misses"]
+        yield "cache_errors", "Failed cache operations since start.", labels, stats["errors"]
+    queues = {"layout": LAYOUT_POOL.stats(), "graphviz": GRAPH_RENDERER.stats()}
+    for name, stats in queues.items():
+        labels = {"queue": name}
+        yield "queue_pending", "Jobs queued or running.", labels, stats["pending"]
+        yield "queue_max_pending", "Jobs allowed to be queued or running.", labels, stats["max_queue"]
+        yield "queue_workers", "Workers serving the queue.", labels, stats["workers"]
+        yield "queue_rejected", "Jobs rejected because the queue was full.", labels, stats["rejected"]
+        yield "queue_timeouts", "Jobs that missed their deadline.", labels, stats["timeouts"]
+    for limiter in (DIAGRAM_LIMIT, GRAPH_LIMIT, BATCH_LIMIT):
+        stats = limiter.stats()
+        labels = {"endpoint": limiter.name}
+        yield "requests_in_flight", "Requests holding a concurrency slot.", labels, stats["in_flight"]
+        yield "requests_limit", "Concurrency slots of the endpoint.", labels, stats["limit"]
+        yield "requests_rejected", "Requests rejected for lack of a slot.", labels, stats["rejected"]
+    janitor = JANITOR.stats()
+    yield "diagram_files", "Diagram files indexed by the janitor.", None, janitor["indexed_files"]
+    yield "diagram_files_removed", "Diagram files removed by the janitor.", None, janitor["files_removed"]
+    store = STATE_STORE.stats()
+    yield "stored_states", "Parser states in the state store.", {"backend": store["backend"]}, store["states"]
+
+
+METRICS.gauges(metric_gauges)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Returns the stage latency histograms and the cache / queue gauges in the Prometheus
+    text format. Only served when the server runs with METRICS_ENABLED=1.
+    """
+    if not METRICS.enabled:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/render-graph', methods=['POST'])
-def render_graph():
+@GRAPH_LIMIT
+async def render_graph():
     """
     Accepts {"dot": "DOT description"}.
     Renders the GraphViz graph as an SVG and returns the SVG content.
+    Answers 503 when the render queue is full and 504 when GraphViz times out.
     """
     try:
         dot = request.json.get("dot", "")
         if not dot:
             return jsonify({"error": "No DOT provided"}), 400
-        src = Source(dot, format="svg")
-        svg = src.pipe().decode("utf-8")
+        svg = await GRAPH_RENDERER.render_async(dot)
         return jsonify({"svg": svg})
+    except RenderQueueFull as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+    except RenderTimeout as e:
+        logging.error(e)
+        return jsonify({"error": str(e)}), 504
     except Exception as e:
         logging.error(e)
         return jsonify({"error": str(e)}), 500
 
+# Every view above can be profiled on demand
+PROFILER.instrument(app)
+
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def admin_profile():
+    """
+    Admin only (header "X-Admin-Token: <PROFILE_TOKEN>"); 404 when PROFILE_TOKEN is not set.
+    POST {"requests": 1, "endpoint": null, "mode": "cprofile" | "sample", "tracemalloc": false,
+    "interval": 0.005} profiles the next requests (of one endpoint, e.g. "generate_regex",
+    if given) of this worker: pstats (.prof) or collapsed stacks (.collapsed), plus the top
+    allocation sites (.alloc.txt) with tracemalloc, written to PROFILE_DIR.
+    GET returns the session and the files written so far, DELETE stops it.
+    Answers 409 while a session runs and 429 when armed again within a minute.
+    """
+    if not PROFILE_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode("utf-8"),
+                               PROFILE_TOKEN.encode("utf-8")):
+        return jsonify({"error": "Forbidden"}), 403
+    if request.method == "DELETE":
+        PROFILER.cancel()
+    elif request.method == "POST":
+        options = request.get_json(silent=True) or {}
+        try:
+            endpoint = options.get("endpoint")
+            if endpoint is not None and endpoint not in app.view_functions:
+                return jsonify({"error": f"Unknown endpoint: {endpoint}"}), 400
+            status = PROFILER.arm(requests=int(options.get("requests", 1)), endpoint=endpoint,
+                                  mode=options.get("mode", "cprofile"),
+                                  trace_memory=bool(options.get("tracemalloc", False)),
+                                  interval=float(options.get("interval", 0.005)))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except ProfilerBusy as e:
+            return jsonify({"error": str(e)}), 409
+        except ProfilerRateLimited as e:
+            return jsonify({"error": str(e)}), 429, {"Retry-After": str(PROFILER.min_interval)}
+        logging.info("Profiling armed: %s", status)
+        return jsonify(status)
+    return jsonify(PROFILER.status())
+
 if __name__ == '__main__':
     app.run(debug=False)
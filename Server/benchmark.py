@@ -0,0 +1,204 @@
+"""
+Benchmarks for the regex -> diagram -> parser pipeline.
+
+Generates synthetic regexes of growing size, nesting depth and alternation width and
+times every stage separately. Results are written as JSON and can be compared with a
+previously saved run:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json --threshold 1.25
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+import RegexAlgorithm
+from RegexAlgorithm import ExpressionParser
+from diagramGenerator import parse_regex, build_diagram_item
+from railroadBib import Diagram, get_terminal_ids
+
+BRACKETS = ["()", "[]", "{}"]
+SYMBOLS = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+
+def generate_regex(length, depth, width, seed=0):
+    """
+    Build a valid regex with roughly `length` terminals, brackets nested `depth`
+    levels deep and `width` alternatives at every level.
+    """
+    rng = random.Random(seed)
+    leaves = max(1, width ** depth)
+    per_leaf = max(1, length // leaves)
+
+    def build(level):
+        if level == depth:
+            return "".join(rng.choice(SYMBOLS) for _ in range(per_leaf))
+        branches = []
+        for i in range(width):
+            opening, closing = BRACKETS[(level + i) % len(BRACKETS)]
+            branches.append(opening + build(level + 1) + closing)
+        return "|".join(branches)
+
+    return build(0)
+
+
+def measure(fn, setup=None, repeat=5):
+    """
+    Time fn(setup()) `repeat` times (setup is not timed). Returns min/median/max in seconds.
+    """
+    samples = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        fn(arg)
+        samples.append(time.perf_counter() - start)
+    return {"min": min(samples), "median": statistics.median(samples), "max": max(samples)}
+
+
+def random_walk(regex, id_list, steps, seed=0):
+    """
+    Pick a sequence of symbols that stays inside the language for as long as possible.
+    """
+    rng = random.Random(seed)
+    parser = ExpressionParser(regex, id_list)
+    walk = []
+    for _ in range(steps):
+        symbols = sorted(parser.unique_chars_after_dot())
+        if not symbols:
+            break
+        symbol = rng.choice(symbols)
+        walk.append(symbol)
+        parser.do_cycle(symbol)
+    return walk
+
+
+def bytes_per_terminal(tree, terminals):
+    tracemalloc.start()
+    try:
+        diagram = Diagram(build_diagram_item(tree, root=True))
+        diagram.format()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return current // max(1, terminals)
+
+
+def run_case(length, depth, width, repeat=5, steps=200, memory=False):
+    """
+    Benchmark every stage for one synthetic regex.
+    """
+    regex = generate_regex(length, depth, width)
+    tree = parse_regex(regex)
+    id_list = get_terminal_ids(Diagram(build_diagram_item(tree, root=True)))
+    walk = random_walk(regex, id_list, steps)
+
+    def fresh_parser(_=None):
+        RegexAlgorithm._compile.cache_clear()
+        return ExpressionParser(regex, id_list)
+
+    def replay(parser):
+        for symbol in walk:
+            parser.do_cycle(symbol)
+
+    timings = {
+        # Validation, tokenizing and parsing are a single pass
+        "parse_regex": measure(lambda _: parse_regex(regex), repeat=repeat),
+        "build_diagram_item": measure(lambda _: build_diagram_item(tree, root=True), repeat=repeat),
+        "Diagram": measure(lambda root: Diagram(root), lambda: build_diagram_item(tree, root=True), repeat=repeat),
+        "Diagram.format": measure(lambda d: d.format(), lambda: Diagram(build_diagram_item(tree, root=True)),
+                                  repeat=repeat),
+        "writeStandalone": measure(lambda d: d.writeStandalone(lambda text: None),
+                                   lambda: Diagram(build_diagram_item(tree, root=True)).format(), repeat=repeat),
+        "ExpressionParser.__init__": measure(fresh_parser, lambda: RegexAlgorithm._compile.cache_clear(),
+                                             repeat=repeat),
+        # First walk over a freshly compiled automaton (states are discovered on the way)
+        "do_cycle.cold": measure(replay, fresh_parser, repeat=repeat),
+        # Same walk again, every state and transition already memoized
+        "do_cycle.warm": measure(replay, lambda: ExpressionParser(regex, id_list), repeat=repeat),
+    }
+    result = {
+        "name": f"length={length},depth={depth},width={width}",
+        "regex_length": len(regex),
+        "terminals": len(id_list),
+        "steps": len(walk),
+        "timings": timings,
+    }
+    if memory:
+        result["bytes_per_terminal"] = bytes_per_terminal(tree, len(id_list))
+    return result
+
+
+def compare(results, baseline, threshold):
+    """
+    Print median ratios against a baseline run. Returns the list of regressions.
+    """
+    previous = {case["name"]: case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        old = previous.get(case["name"])
+        if old is None:
+            continue
+        print(case["name"])
+        for stage, timing in case["timings"].items():
+            if stage not in old["timings"]:
+                continue
+            before = old["timings"][stage]["median"]
+            after = timing["median"]
+            ratio = after / before if before else float("inf")
+            flag = ""
+            if ratio > threshold:
+                flag = "  REGRESSION"
+                regressions.append((case["name"], stage, ratio))
+            print(f"  {stage:28s} {before * 1e3:10.3f} ms -> {after * 1e3:10.3f} ms  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 3])
+    parser.add_argument("--widths", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--steps", type=int, default=200, help="length of the do_cycle walk")
+    parser.add_argument("--memory", action="store_true", help="also report bytes per terminal")
+    parser.add_argument("--output", help="write results as JSON to this file (default: stdout)")
+    parser.add_argument("--baseline", help="compare against a JSON file from an earlier run")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="median slowdown ratio reported as a regression")
+    args = parser.parse_args(argv)
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cases": [
+            run_case(length, depth, width, args.repeat, args.steps, args.memory)
+            for length in args.lengths
+            for depth in args.depths
+            for width in args.widths
+        ],
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    elif not args.baseline:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} stage(s) slower than x{args.threshold}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
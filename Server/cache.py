@@ -0,0 +1,383 @@
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+import hashlib
+import zlib
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+# Returned by CacheBackend._get when the key is absent (None is a valid value)
+MISSING = object()
+
+COMPRESS_MIN_SIZE = 512  # serialized values at least this long are zlib-compressed
+
+
+def dumps(value):
+    """
+    Serialize a cache value compactly: JSON (tuples come back as lists), zlib-compressed
+    when it is large. The first byte tells which.
+    """
+    data = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    if len(data) >= COMPRESS_MIN_SIZE:
+        return b"z" + zlib.compress(data)
+    return b"j" + data
+
+
+def loads(data):
+    if data[:1] == b"z":
+        return json.loads(zlib.decompress(data[1:]))
+    return json.loads(data[1:])
+
+
+def key_text(key):
+    """
+    Turn a cache key (a string or a tuple of strings/numbers) into a short fixed-length text key.
+    """
+    text = key if isinstance(key, str) else json.dumps(key, separators=(",", ":"))
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class CacheBackend:
+    """
+    Common part of the cache backends: hit/miss counters and the time spent in get/put.
+
+    Subclasses implement _get(key) (returning MISSING for an absent key), _put(key, value),
+    __contains__, __len__ and clear. A failing shared backend (database locked, server
+    gone) never fails the request: the error is counted and the call behaves as a miss.
+    """
+
+    name = "cache"
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.get_seconds = 0.0
+        self.puts = 0
+        self.put_seconds = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _failed(self, action, error):
+        with self._stats_lock:
+            self.errors += 1
+        logging.warning("%s cache %s failed: %s", self.name, action, error)
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for key, or default.
+        """
+        start = time.perf_counter()
+        try:
+            value = self._get(key)
+        except Exception as e:
+            self._failed("get", e)
+            value = MISSING
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.get_seconds += elapsed
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return default if value is MISSING else value
+
+    def put(self, key, value):
+        """
+        Store value under key, evicting old entries if the backend is full.
+        """
+        start = time.perf_counter()
+        try:
+            self._put(key, value)
+        except Exception as e:
+            self._failed("put", e)
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.puts += 1
+            self.put_seconds += elapsed
+
+    def size(self):
+        """
+        Number of entries, or None when the backend cannot tell cheaply.
+        """
+        try:
+            return len(self)
+        except Exception as e:
+            self._failed("size", e)
+            return None
+
+    def stats(self):
+        """
+        Return the backend name, size, hit/miss counters and average get/put latency.
+        """
+        size = self.size()
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": self.name,
+                "size": size,
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "errors": self.errors,
+                "avg_get_ms": self.get_seconds * 1000 / lookups if lookups else 0.0,
+                "avg_put_ms": self.put_seconds * 1000 / self.puts if self.puts else 0.0,
+            }
+
+
+class LRUCache(CacheBackend):
+    """
+    A small thread-safe least-recently-used cache, private to the process.
+    Values are kept as they are (not serialized), so anything can be cached.
+    """
+
+    name = "memory"
+
+    def __init__(self, maxsize=1024, on_evict=None):
+        super().__init__(maxsize)
+        # Called as on_evict(key, value) for entries pushed out by put()
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def _put(self, key, value):
+        evicted = []
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False))
+        if self.on_evict is not None:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SqliteCache(CacheBackend):
+    """
+    A cache in a sqlite file, shared by every worker process on the node.
+    Several caches can live in one file, separated by namespace. When a namespace
+    grows past maxsize, its oldest entries are deleted.
+    """
+
+    name = "sqlite"
+    TRIM_EVERY = 100  # puts between two size checks
+
+    def __init__(self, path, namespace="cache", maxsize=10000, timeout=1.0):
+        super().__init__(maxsize)
+        self.path = path
+        self.namespace = namespace
+        self._puts_since_trim = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                             "value BLOB NOT NULL, stored REAL NOT NULL, PRIMARY KEY (namespace, key))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS cache_stored ON cache (namespace, stored)")
+
+    def _get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM cache WHERE namespace = ? AND key = ?",
+                                   (self.namespace, key_text(key))).fetchone()
+        return MISSING if row is None else loads(row[0])
+
+    def _put(self, key, value):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                             (self.namespace, key_text(key), dumps(value), time.time()))
+            self._puts_since_trim += 1
+            if self._puts_since_trim >= self.TRIM_EVERY:
+                self._puts_since_trim = 0
+                self._trim()
+
+    def _trim(self):
+        count = self._db.execute("SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+        if count > self.maxsize:
+            self._db.execute("DELETE FROM cache WHERE namespace = ? AND key IN (SELECT key FROM cache "
+                             "WHERE namespace = ? ORDER BY stored LIMIT ?)",
+                             (self.namespace, self.namespace, count - self.maxsize))
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM cache WHERE namespace = ? AND key = ?",
+                                    (self.namespace, key_text(key))).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM cache WHERE namespace = ?",
+                                    (self.namespace,)).fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+
+class RedisError(Exception):
+    """
+    An error reply from the Redis server.
+    """
+
+
+class RedisCache(CacheBackend):
+    """
+    A cache on a Redis server (or anything speaking its protocol), shared by every
+    worker on every node. Speaks RESP directly over one socket, so no client library
+    is needed. Entries expire after ttl seconds; the size limit is left to the server's
+    maxmemory policy.
+    """
+
+    name = "redis"
+
+    def __init__(self, url="redis://localhost:6379/0", namespace="cache", ttl=86400, timeout=1.0):
+        super().__init__(None)
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.db = int(parts.path.lstrip("/") or 0)
+        self.password = parts.password
+        self.namespace = namespace
+        self.ttl = ttl
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile("rb")
+        if self.password:
+            self._send("AUTH", self.password)
+        if self.db:
+            self._send("SELECT", self.db)
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._reader.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = self._reader = None
+
+    def _send(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._sock.sendall(b"".join(parts))
+        return self._read()
+
+    def _read(self):
+        line = self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection to Redis closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise RedisError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            return self._reader.read(length + 2)[:-2]
+        if kind == b"*":
+            length = int(rest)
+            return None if length < 0 else [self._read() for _ in range(length)]
+        raise RedisError(f"Unexpected reply {line!r}")
+
+    def command(self, *args):
+        """
+        Send one command and return its reply, reconnecting once if the connection broke.
+        """
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._send(*args)
+                except (OSError, ConnectionError):
+                    self._close()
+                    if attempt == 2:
+                        raise
+
+    def _key(self, key):
+        return f"{self.namespace}:{key_text(key)}"
+
+    def _get(self, key):
+        data = self.command("GET", self._key(key))
+        return MISSING if data is None else loads(data)
+
+    def _put(self, key, value):
+        self.command("SET", self._key(key), dumps(value), "EX", self.ttl)
+
+    def _keys(self):
+        cursor = "0"
+        while True:
+            cursor, keys = self.command("SCAN", cursor, "MATCH", f"{self.namespace}:*", "COUNT", 1000)
+            yield from keys
+            cursor = cursor.decode("ascii")
+            if cursor == "0":
+                return
+
+    def __contains__(self, key):
+        return self.command("EXISTS", self._key(key)) == 1
+
+    def __len__(self):
+        return sum(1 for _ in self._keys())
+
+    def size(self):
+        # Counting means scanning the whole keyspace: not done for stats
+        return None
+
+    def clear(self):
+        keys = list(self._keys())
+        for start in range(0, len(keys), 500):
+            self.command("DEL", *keys[start:start + 500])
+
+
+def make_cache(url, namespace, maxsize, on_evict=None):
+    """
+    Create a cache from a backend URL:
+      None or "memory"           in-process LRUCache (the only backend calling on_evict)
+      "sqlite:///path/cache.db"  SqliteCache shared by the workers of one node
+      "redis://host:port/db"     RedisCache shared by every node
+    Shared backends store serialized values, so they only take JSON-compatible values.
+    """
+    if not url or url == "memory":
+        return LRUCache(maxsize=maxsize, on_evict=on_evict)
+    scheme = urlsplit(url).scheme
+    if scheme == "sqlite":
+        return SqliteCache(url[len("sqlite://"):], namespace=namespace, maxsize=maxsize)
+    if scheme in ("redis", "rediss"):
+        if scheme == "rediss":
+            raise ValueError("TLS Redis connections are not supported")
+        return RedisCache(url, namespace=namespace)
+    raise ValueError(f"Unknown cache backend: {url}")
@@ -0,0 +1,87 @@
+import asyncio
+import functools
+import inspect
+import threading
+import time
+
+from flask import jsonify
+
+
+class ConcurrencyLimiter:
+    """
+    Caps how many requests of one kind of endpoint run at the same time.
+
+    Heavy endpoints (diagram layout, graph rendering, batches) get limits that add up
+    to less than the number of server threads, so cheap calls such as
+    /generate-transition always find a free thread while heavy work is in flight.
+    A request that cannot get a slot within `wait` seconds is answered with 503
+    instead of queueing behind the heavy work. Use an instance as a view decorator.
+    """
+
+    def __init__(self, name, limit, wait=0.5):
+        self.name = name
+        self.limit = limit
+        self.wait = wait
+        self.in_flight = 0
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+
+    def _acquired(self, acquired):
+        with self._lock:
+            if acquired:
+                self.in_flight += 1
+            else:
+                self.rejected += 1
+        return acquired
+
+    def acquire(self):
+        """
+        Take a slot, waiting at most `wait` seconds. Returns False if none was free.
+        """
+        return self._acquired(self._slots.acquire(timeout=self.wait))
+
+    async def acquire_async(self):
+        """
+        Like acquire(), without blocking the event loop while waiting.
+        """
+        deadline = time.monotonic() + self.wait
+        while not self._slots.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                return self._acquired(False)
+            await asyncio.sleep(0.01)
+        return self._acquired(True)
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def busy_response(self):
+        return jsonify({"error": f"Too many {self.name} requests in progress, try again later"}), 503, \
+            {"Retry-After": "1"}
+
+    def __call__(self, view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def limited(*args, **kwargs):
+                if not await self.acquire_async():
+                    return self.busy_response()
+                try:
+                    return await view(*args, **kwargs)
+                finally:
+                    self.release()
+        else:
+            @functools.wraps(view)
+            def limited(*args, **kwargs):
+                if not self.acquire():
+                    return self.busy_response()
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self.release()
+        return limited
+
+    def stats(self):
+        with self._lock:
+            return {"limit": self.limit, "in_flight": self.in_flight, "rejected": self.rejected}
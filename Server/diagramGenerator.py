@@ -1,151 +1,192 @@
-import re
+from functools import lru_cache
 from railroadBib import Diagram, Choice, Sequence, Optional, ZeroOrMore, Terminal, get_terminal_ids
 
+SYMBOL_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789")
+BRACKET_PAIRS = {'(': ')', '[': ']', '{': '}'}
+BRACKET_NAMES = {'(': "parentheses '()'", '[': "square brackets '[]'", '{': "curly braces '{}'"}
+MAX_NESTING = 200  # deeper nesting would exhaust the recursion of the parser and the diagram layout
 
-class Token:
-    GROUP_START = 'GROUP_START'
-    GROUP_END = 'GROUP_END'
-    OPTIONAL_START = 'OPTIONAL_START'
-    OPTIONAL_END = 'OPTIONAL_END'
-    REPETITION_START = 'REPETITION_START'
-    REPETITION_END = 'REPETITION_END'
-    ALTERNATION = 'ALTERNATION'
+
+class Kind:
     SYMBOL = 'SYMBOL'
+    SEQUENCE = 'SEQUENCE'
+    CHOICE = 'CHOICE'
+    GROUP = 'GROUP'
+    OPTIONAL = 'OPTIONAL'
+    REPETITION = 'REPETITION'
 
 
-def validate_regex_input(regex):
+BRACKET_KINDS = {'(': Kind.GROUP, '[': Kind.OPTIONAL, '{': Kind.REPETITION}
+
+
+class RegexSyntaxError(ValueError):
+    """A regex that cannot be drawn; position is the offset of the offending character."""
+
+    def __init__(self, message, position):
+        super().__init__(f"{message} (at character {position + 1})")
+        self.position = position
+
+
+class RegexNode:
+    """
+    A node of the parsed regex. start/end are offsets into the source (end exclusive):
+      - SYMBOL: a terminal, symbol holds the character
+      - SEQUENCE: one or more items read one after another
+      - CHOICE: two or more SEQUENCE alternatives separated by '|'
+      - GROUP / OPTIONAL / REPETITION: '()', '[]' or '{}' around a single child
+    """
+    __slots__ = ("kind", "start", "end", "children", "symbol")
+
+    def __init__(self, kind, start, end, children=(), symbol=None):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.children = children if isinstance(children, list) else list(children)
+        self.symbol = symbol
+
+    def terminals(self):
+        """Yields the SYMBOL nodes in source order."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.kind == Kind.SYMBOL:
+                yield node
+            else:
+                stack.extend(reversed(node.children))
+
+    def __repr__(self):
+        if self.kind == Kind.SYMBOL:
+            return f"RegexNode(SYMBOL, {self.start}, {self.symbol!r})"
+        return f"RegexNode({self.kind}, {self.start}, {self.end}, {self.children!r})"
+
+
+class _Parser:
+    """Recursive-descent parser that validates the regex while building the tree in one pass."""
+
+    def __init__(self, regex):
+        self.regex = regex
+        self.i = 0
+
+    def parse(self):
+        if not self.regex:
+            raise RegexSyntaxError("The regex is empty.", 0)
+        root = self.alternation(0)
+        if self.i < len(self.regex):
+            # alternation() only stops early at a closing bracket
+            raise RegexSyntaxError(
+                "Unbalanced brackets: found a closing bracket without a matching opening bracket.", self.i)
+        return root
+
+    def alternation(self, depth):
+        start = self.i
+        branches = [self.sequence(depth)]
+        while self.i < len(self.regex) and self.regex[self.i] == '|':
+            self.i += 1
+            branches.append(self.sequence(depth))
+        if len(branches) == 1:
+            return branches[0]
+        return RegexNode(Kind.CHOICE, start, self.i, branches)
+
+    def sequence(self, depth):
+        start = i = self.i
+        items = []
+        regex = self.regex
+        length = len(regex)
+        while i < length:
+            char = regex[i]
+            if char in SYMBOL_CHARS:
+                items.append(RegexNode(Kind.SYMBOL, i, i + 1, (), char))
+                i += 1
+            elif char in BRACKET_PAIRS:
+                self.i = i
+                items.append(self.bracket(depth + 1))
+                i = self.i
+            elif char == '|' or char in ")]}":
+                break
+            else:
+                raise RegexSyntaxError(
+                    "Invalid characters in regex. Only English letters, digits, and the symbols ()[]{}| are allowed.",
+                    i)
+        self.i = i
+        if not items:
+            if start > 0 and regex[start - 1] in BRACKET_PAIRS and self.i < len(regex) \
+                    and regex[self.i] == BRACKET_PAIRS[regex[start - 1]]:
+                opening = regex[start - 1]
+                raise RegexSyntaxError(f"Empty {BRACKET_NAMES[opening]} are not allowed.", start - 1)
+            raise RegexSyntaxError("Empty alternative: '|' must have something on both sides.", self.i)
+        return RegexNode(Kind.SEQUENCE, start, self.i, items)
+
+    def bracket(self, depth):
+        start = self.i
+        opening = self.regex[start]
+        if depth > MAX_NESTING:
+            raise RegexSyntaxError("Brackets are nested too deeply.", start)
+        self.i += 1
+        body = self.alternation(depth)
+        if self.i >= len(self.regex):
+            raise RegexSyntaxError("Unbalanced brackets: not all opening brackets are closed.", start)
+        if self.regex[self.i] != BRACKET_PAIRS[opening]:
+            raise RegexSyntaxError("Unbalanced brackets: mismatched bracket found.", self.i)
+        self.i += 1
+        return RegexNode(BRACKET_KINDS[opening], start, self.i, [body])
+
+
+@lru_cache(maxsize=256)
+def parse_regex(regex):
     """
-    Validates the input regex:
+    Validates and parses the regex in a single pass:
       - Only allows English letters, digits, and these symbols: ()[]{}|
       - Ensures that every opening bracket has a corresponding closing bracket.
-      - Ensures that empty brackets ((), [], {}) are not allowed.
+      - Ensures that empty brackets ((), [], {}) and empty alternatives are not allowed.
+    Returns the root RegexNode; raises RegexSyntaxError with the offending position.
+    Results are cached and shared (by the diagram and the ExpressionParser), so the tree must not be modified.
     """
-    # Only allow English letters (A-Z, a-z), digits (0-9), and these symbols: ()[]{}|
-    if not re.fullmatch(r'[A-Za-z0-9\(\)\[\]\{\}\|]+', regex):
-        raise ValueError(
-            "Invalid characters in regex. Only English letters, digits, and the symbols ()[]{}| are allowed.")
-
-    # Check for empty brackets: (), [] or {}
-    if re.search(r'\(\)', regex):
-        raise ValueError("Empty parentheses '()' are not allowed.")
-    if re.search(r'\[\]', regex):
-        raise ValueError("Empty square brackets '[]' are not allowed.")
-    if re.search(r'\{\}', regex):
-        raise ValueError("Empty curly braces '{}' are not allowed.")
-
-    # Check for balanced brackets using a simple stack approach
-    stack = []
-    pairs = {'(': ')', '[': ']', '{': '}'}
-    for char in regex:
-        if char in pairs:
-            stack.append(char)
-        elif char in pairs.values():
-            if not stack:
-                raise ValueError("Unbalanced brackets: found a closing bracket without a matching opening bracket.")
-            last = stack.pop()
-            if pairs[last] != char:
-                raise ValueError("Unbalanced brackets: mismatched bracket found.")
-    if stack:
-        raise ValueError("Unbalanced brackets: not all opening brackets are closed.")
-
-
-def tokenize(regex):
-    """Tokenizes the regular expression into tokens."""
-    tokens = []
-    i = 0
-    while i < len(regex):
-        char = regex[i]
-        if char == '(':
-            tokens.append((Token.GROUP_START, char))
-        elif char == ')':
-            tokens.append((Token.GROUP_END, char))
-        elif char == '[':
-            tokens.append((Token.OPTIONAL_START, char))
-        elif char == ']':
-            tokens.append((Token.OPTIONAL_END, char))
-        elif char == '{':
-            tokens.append((Token.REPETITION_START, char))
-        elif char == '}':
-            tokens.append((Token.REPETITION_END, char))
-        elif char == '|':
-            tokens.append((Token.ALTERNATION, char))
-        else:
-            tokens.append((Token.SYMBOL, char))
-        i += 1
-    return tokens
-
-
-def parse_tokens(tokens):
-    """Parses tokens to create diagram components."""
-    stack = []
-    current = []
-    choices = []
-    mode_stack = []  # Stack to track the current mode (GROUP, OPTIONAL, REPETITION)
-
-    i = 0
-    while i < len(tokens):
-        token, value = tokens[i]
-
-        if token == Token.GROUP_START:
-            stack.append((current, choices, mode_stack))
-            current = []
-            choices = []
-            mode_stack = ["GROUP"]
-        elif token == Token.GROUP_END:
-            group = Sequence(*current) if len(current) > 1 else current[0]
-            if choices:
-                choices.append(group)
-                group = Choice(0, *choices)
-            current, choices, mode_stack = stack.pop()
-            current.append(group)
-        elif token == Token.OPTIONAL_START:
-            stack.append((current, choices, mode_stack))
-            current = []
-            choices = []
-            mode_stack = ["OPTIONAL"]
-        elif token == Token.OPTIONAL_END:
-            optional = Sequence(*current) if len(current) > 1 else current[0]
-            if choices:
-                choices.append(optional)
-                optional = Choice(0, *choices)
-            current, choices, mode_stack = stack.pop()
-            current.append(Optional(optional))
-        elif token == Token.REPETITION_START:
-            stack.append((current, choices, mode_stack))
-            current = []
-            choices = []
-            mode_stack = ["REPETITION"]
-        elif token == Token.REPETITION_END:
-            zero_or_more = Sequence(*current) if len(current) > 1 else current[0]
-            if choices:
-                choices.append(zero_or_more)
-                zero_or_more = Choice(0, *choices)
-            current, choices, mode_stack = stack.pop()
-            current.append(ZeroOrMore(zero_or_more))
-        elif token == Token.ALTERNATION:
-            if current:
-                choices.append(Sequence(*current) if len(current) > 1 else current[0])
-            current = []
-        elif token == Token.SYMBOL:
-            current.append(Terminal(value))
-
-        i += 1
-
-    if current:
-        if choices:
-            choices.append(Sequence(*current) if len(current) > 1 else current[0])
-            return Choice(0, *choices)
-        else:
-            return Sequence(*current)
-
-
-def generate_svg_from_regex(regex, output_file="static/diagrams/diagram.svg"):
-    validate_regex_input(regex)
-    tokens = tokenize(regex)
-    diagram = Diagram(parse_tokens(tokens))
+    return _Parser(regex).parse()
+
+
+def validate_regex_input(regex):
+    """Raises RegexSyntaxError (a ValueError) if the regex cannot be drawn."""
+    parse_regex(regex)
+
+
+def build_diagram_item(node, root=False):
+    """Converts a parsed regex node into railroad diagram components."""
+    if node.kind == Kind.SYMBOL:
+        return Terminal(node.symbol)
+    if node.kind == Kind.SEQUENCE:
+        items = [build_diagram_item(child) for child in node.children]
+        return Sequence(*items) if len(items) > 1 or root else items[0]
+    if node.kind == Kind.CHOICE:
+        return Choice(0, *(build_diagram_item(child) for child in node.children))
+    body = build_diagram_item(node.children[0])
+    if node.kind == Kind.OPTIONAL:
+        return Optional(body)
+    if node.kind == Kind.REPETITION:
+        return ZeroOrMore(body)
+    return body
+
+
+def build_diagram(tree):
+    """Builds the railroad Diagram of a parsed regex."""
+    return Diagram(build_diagram_item(tree, root=True))
+
+
+def render_svg_from_regex(regex, css=None):
+    """Builds the diagram in memory and returns (svg markup, terminal ids)."""
+    diagram = build_diagram(parse_regex(regex))
+    return diagram.toStandalone(css), get_terminal_ids(diagram)
+
+
+def terminal_ids(regex):
+    """Returns the terminal ids the diagram of regex would get, without rendering it."""
+    return get_terminal_ids(build_diagram(parse_regex(regex)))
+
+
+def generate_svg_from_regex(regex, output_file="static/diagrams/diagram.svg", css=None):
+    svg, ids = render_svg_from_regex(regex, css)
     with open(output_file, "w") as f:
-        diagram.writeStandalone(f.write)
-    return get_terminal_ids(diagram)
+        f.write(svg)
+    return ids
 
 
 if __name__ == '__main__':
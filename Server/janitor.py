@@ -0,0 +1,150 @@
+import os
+import time
+import logging
+import threading
+
+
+class DiagramJanitor:
+    """
+    Deletes expired diagram files from a background thread.
+
+    Instead of scanning the directory on every request, the janitor keeps an
+    in-memory index of filename -> (last use time, size in bytes). Diagrams are
+    registered when they are written and touched when they are served again;
+    the directory itself is only scanned once, on start, to pick up files left
+    over from earlier runs. Expired files are deleted in batches off the request path.
+    The duration of every cleanup pass is passed to observe("cleanup", seconds).
+    """
+
+    def __init__(self, directory, max_age_seconds=86400, interval=60, batch_size=100, observe=None):
+        self.directory = directory
+        self.max_age_seconds = max_age_seconds
+        self.interval = interval
+        self.batch_size = batch_size
+        self.files_removed = 0
+        self.bytes_reclaimed = 0
+        self.errors = 0
+        self.observe = observe
+        self._index = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(self, filename, size, created=None):
+        """
+        Add a freshly written diagram to the index.
+        """
+        with self._lock:
+            self._index[filename] = (time.time() if created is None else created, size)
+
+    def touch(self, filename):
+        """
+        Mark a diagram as used now so it does not expire.
+        """
+        with self._lock:
+            entry = self._index.get(filename)
+            if entry is not None:
+                self._index[filename] = (time.time(), entry[1])
+
+    def discard(self, filename):
+        """
+        Schedule a diagram for deletion in the next batch.
+        """
+        with self._lock:
+            entry = self._index.get(filename)
+            if entry is not None:
+                self._index[filename] = (0, entry[1])
+
+    def scan(self):
+        """
+        Index the files already present in the directory (used once on start).
+        """
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                with self._lock:
+                    self._index.setdefault(entry.name, (stat.st_mtime, stat.st_size))
+
+    def run_once(self, now=None):
+        """
+        Delete every expired diagram, batch_size files at a time. Returns the number removed.
+        """
+        now = time.time() if now is None else now
+        deadline = now - self.max_age_seconds
+        with self._lock:
+            expired = [name for name, (used, _) in self._index.items() if used < deadline]
+        removed = 0
+        for start in range(0, len(expired), self.batch_size):
+            batch = expired[start:start + self.batch_size]
+            batch_removed = 0
+            batch_bytes = 0
+            for filename in batch:
+                with self._lock:
+                    entry = self._index.get(filename)
+                    # Skip files that were touched again since the expiry check
+                    if entry is None or entry[0] >= deadline:
+                        continue
+                    del self._index[filename]
+                file_path = os.path.join(self.directory, filename)
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    # Already removed, e.g. by another worker
+                    continue
+                except Exception as e:
+                    self.errors += 1
+                    logging.error("Error removing file %s: %s", file_path, e)
+                    continue
+                batch_removed += 1
+                batch_bytes += entry[1]
+            removed += batch_removed
+            with self._lock:
+                self.files_removed += batch_removed
+                self.bytes_reclaimed += batch_bytes
+            if self._stop.is_set():
+                break
+        if removed:
+            logging.info("Removed %d old diagrams", removed)
+        return removed
+
+    def _run(self):
+        try:
+            self.scan()
+        except Exception as e:
+            logging.error("Error indexing %s: %s", self.directory, e)
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error("Diagram janitor failed: %s", e)
+            if self.observe is not None:
+                self.observe("cleanup", time.perf_counter() - start)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        Start the background thread (idempotent).
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="diagram-janitor", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        """
+        Return the index size and the files removed / bytes reclaimed so far.
+        """
+        with self._lock:
+            return {
+                "indexed_files": len(self._index),
+                "files_removed": self.files_removed,
+                "bytes_reclaimed": self.bytes_reclaimed,
+                "errors": self.errors,
+            }
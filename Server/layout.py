@@ -0,0 +1,204 @@
+import asyncio
+import cProfile
+import multiprocessing
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from diagramGenerator import build_diagram, parse_regex, validate_regex_input
+from railroadBib import get_terminal_ids
+
+# Extra time the caller waits for a job past its deadline, for the worker to report back
+DEADLINE_GRACE = 0.5
+
+
+class LayoutQueueFull(Exception):
+    """
+    Raised when too many diagrams are already waiting for a layout worker.
+    """
+
+
+class LayoutTimeout(Exception):
+    """
+    Raised when a diagram is not laid out before its deadline.
+    """
+
+
+def _deadline_passed(signum, frame):
+    raise LayoutTimeout("Laying out the diagram took too long")
+
+
+def _layout(regex, css, deadline, profile_path=None):
+    """
+    Runs in a pool process: build, lay out and serialize the diagram of regex.
+    Returns (svg markup, terminal ids, {stage: seconds}). The ids are assigned by the
+    Diagram itself (depth-first from FIRST_TERMINAL_ID), so they do not depend on which
+    process drew it. A job still running at its deadline is interrupted with SIGALRM so
+    the worker is free for the next one. With profile_path the job runs under cProfile
+    and its stats are written there.
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise LayoutTimeout("The diagram waited in the queue past its deadline")
+    timed = hasattr(signal, "setitimer")
+    if timed:
+        previous = signal.signal(signal.SIGALRM, _deadline_passed)
+        signal.setitimer(signal.ITIMER_REAL, remaining)
+    profile = cProfile.Profile() if profile_path else None
+    if profile is not None:
+        profile.enable()
+    try:
+        timings = {}
+        start = time.perf_counter()
+        tree = parse_regex(regex)
+        timings["parse"] = time.perf_counter() - start
+        start = time.perf_counter()
+        diagram = build_diagram(tree)
+        timings["build"] = time.perf_counter() - start
+        start = time.perf_counter()
+        diagram.format()
+        timings["format"] = time.perf_counter() - start
+        start = time.perf_counter()
+        svg = diagram.toStandalone(css)
+        timings["svg_write"] = time.perf_counter() - start
+        return svg, get_terminal_ids(diagram), timings
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(profile_path)
+        if timed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+class LayoutPool:
+    """
+    Lays out diagrams in a bounded pool of worker processes, so a pathological
+    regex holds a worker process instead of a request thread.
+
+    Every job has a deadline (timeout seconds after submission): jobs still queued
+    at the deadline are cancelled, running ones are interrupted inside the worker.
+    At most max_queue jobs may be queued or running; past that submit() raises
+    LayoutQueueFull so the caller can answer 503 instead of piling up work.
+    The regex is validated in the calling process first, so syntax errors never use a worker.
+    The stage timings measured by the workers are passed to observe(stage, seconds).
+    """
+
+    def __init__(self, max_workers=2, max_queue=8, timeout=5, observe=None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.observe = observe
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self):
+        # spawn: the server is multi-threaded, forking it could copy held locks
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+            if not future.cancelled() and future.exception() is None:
+                self.completed += 1
+
+    def submit(self, regex, css=None, timeout=None, profile_path=None):
+        """
+        Queue the layout of regex. Returns (future, deadline as a time.time() value).
+        With profile_path the worker profiles the job and writes the stats to that file.
+        """
+        start = time.perf_counter()
+        validate_regex_input(regex)
+        if self.observe is not None:
+            self.observe("validate", time.perf_counter() - start)
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        with self._lock:
+            if self.pending >= self.max_queue:
+                self.rejected += 1
+                raise LayoutQueueFull("Too many diagrams are being drawn, try again later")
+            self.pending += 1
+            executor = self._executor
+        try:
+            future = executor.submit(_layout, regex, css, deadline, profile_path)
+        except Exception:
+            with self._lock:
+                self.pending -= 1
+            raise
+        future.add_done_callback(self._done)
+        return future, deadline
+
+    def _failed(self, error, future=None):
+        """
+        Count a failed job and return the exception to raise for it.
+        """
+        with self._lock:
+            if isinstance(error, LayoutTimeout):
+                self.timeouts += 1
+            else:
+                self.failures += 1
+            if isinstance(error, BrokenProcessPool):
+                # A worker died (e.g. killed for memory); start a fresh pool for the next jobs
+                self._executor = self._new_executor()
+        if future is not None:
+            # Drops the job if it is still queued; a running one stops at its deadline
+            future.cancel()
+        return error
+
+    def _result(self, result):
+        svg, id_list, timings = result
+        if self.observe is not None:
+            for stage, seconds in timings.items():
+                self.observe(stage, seconds)
+        return svg, id_list
+
+    def render(self, regex, css=None, timeout=None, profile_path=None):
+        """
+        Return (svg markup, terminal ids) for regex, waiting at most until the deadline.
+        """
+        future, deadline = self.submit(regex, css, timeout, profile_path)
+        try:
+            result = future.result(timeout=max(0, deadline - time.time()) + DEADLINE_GRACE)
+        except FutureTimeout:
+            raise self._failed(LayoutTimeout("Laying out the diagram took too long"), future)
+        except (LayoutTimeout, BrokenProcessPool) as e:
+            raise self._failed(e)
+        return self._result(result)
+
+    async def render_async(self, regex, css=None, timeout=None, profile_path=None):
+        """
+        Like render(), awaiting the worker instead of blocking the thread.
+        """
+        future, deadline = self.submit(regex, css, timeout, profile_path)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future),
+                                            max(0, deadline - time.time()) + DEADLINE_GRACE)
+        except asyncio.TimeoutError:
+            raise self._failed(LayoutTimeout("Laying out the diagram took too long"), future)
+        except (LayoutTimeout, BrokenProcessPool) as e:
+            raise self._failed(e)
+        return self._result(result)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def stats(self):
+        """
+        Return the queue depth and the completed / rejected / timed out / failed job counts.
+        """
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "pending": self.pending,
+                "max_queue": self.max_queue,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "failures": self.failures,
+            }
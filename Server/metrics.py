@@ -0,0 +1,143 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Upper bounds of the replay length histogram buckets (symbols replayed with do_cycle)
+LENGTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels.items():
+        text = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{name}="{text}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class Histogram:
+    """
+    A Prometheus histogram, optionally split by the value of one label.
+    """
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.label = label
+        # label value -> [bucket counts, sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def lines(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted(self._series.items(), key=lambda item: str(item[0]))
+            series = [(label_value, list(counts), total, count) for label_value, (counts, total, count) in series]
+        for label_value, counts, total, count in series:
+            labels = {self.label: label_value} if self.label is not None else {}
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                bucket_labels = dict(labels, le=format_value(bound))
+                lines.append(f"{self.name}_bucket{format_labels(bucket_labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+class Metrics:
+    """
+    Stage latency histograms and gauges of one server process, exported in the
+    Prometheus text format.
+
+    Disabled instances (the default) record nothing: timer() and observe() return
+    at once, so instrumented code costs next to nothing when metrics are off.
+    Gauges are not stored; the collectors registered with gauges() are called when
+    the metrics are rendered, so they always reflect the current stats() of the
+    caches and queues. Every worker process keeps its own metrics.
+    """
+
+    def __init__(self, enabled=False, prefix="regex_diagram"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.stages = Histogram(f"{prefix}_stage_seconds", "Time spent in each stage of request handling.",
+                                label="stage")
+        self.replay_lengths = Histogram(f"{prefix}_replay_length", "Symbols replayed with do_cycle per replay.",
+                                        buckets=LENGTH_BUCKETS)
+        self._collectors = []
+
+    def observe(self, stage, seconds):
+        """
+        Record the duration of a stage (e.g. "parse", "format", "graphviz").
+        """
+        if self.enabled:
+            self.stages.observe(seconds, stage)
+
+    def observe_replay(self, length):
+        if self.enabled:
+            self.replay_lengths.observe(length)
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Time the body of a with block as one observation of stage.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.observe(time.perf_counter() - start, stage)
+
+    def gauges(self, collect):
+        """
+        Register collect(), returning (name, help, {label: value} or None, value) tuples.
+        Names get the metrics prefix; tuples with the same name form one metric.
+        """
+        self._collectors.append(collect)
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text exposition format.
+        """
+        lines = self.stages.lines() + self.replay_lengths.lines()
+        families = {}
+        for collect in self._collectors:
+            for name, help, labels, value in collect():
+                if value is None:
+                    continue
+                family = families.setdefault(f"{self.prefix}_{name}", (help, []))
+                family[1].append(f"{self.prefix}_{name}{format_labels(labels)} {format_value(value)}")
+        for name, (help, samples) in families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
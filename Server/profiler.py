@@ -0,0 +1,248 @@
+import cProfile
+import functools
+import inspect
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextvars import ContextVar
+
+MODES = ("cprofile", "sample")
+MAX_PROFILED_REQUESTS = 100  # per arming
+TOP_ALLOCATIONS = 50  # lines of the tracemalloc report
+
+# Output path prefix of the request being profiled in the current context, if any
+# (lets the layout pool profile the worker side of the same request)
+current_profile = ContextVar("current_profile", default=None)
+
+
+class ProfilerBusy(Exception):
+    """
+    Raised when a profiling session is already running.
+    """
+
+
+class ProfilerRateLimited(Exception):
+    """
+    Raised when profiling is armed again too soon after the previous session.
+    """
+
+
+def collapse(frame):
+    """
+    Return the stack of frame in the collapsed format of flame graph tools: outermost first, ';'-separated.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        names.append(f"{module}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread every interval seconds from a background thread.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = collapse(frame)
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+
+class RequestProfiler:
+    """
+    Profiles the next requests of a live worker on demand, without a redeploy.
+
+    An admin arms it for the next `requests` requests, optionally only those of one
+    endpoint. Each of them is then run under cProfile (writes a .prof file readable
+    with pstats / snakeviz) or under a stack sampler (writes a .collapsed file for
+    flame graph tools), optionally with tracemalloc (writes the top allocation sites
+    in a .alloc.txt file). Diagram layouts done for the request in the layout pool
+    are profiled in the worker too (a .layout.prof file).
+
+    One request is profiled at a time; matching requests arriving meanwhile run
+    normally. A new session can only be armed min_interval seconds after the
+    previous one. Streamed response bodies are produced after the view returns and
+    are not part of the profile.
+    """
+
+    def __init__(self, directory, min_interval=60):
+        self.directory = directory
+        self.min_interval = min_interval
+        self.profiled = 0
+        self._session = None
+        self._last_armed = None
+        self._busy = False
+        self._lock = threading.Lock()
+
+    def arm(self, requests=1, endpoint=None, mode="cprofile", trace_memory=False, interval=0.005):
+        """
+        Profile the next `requests` requests (of `endpoint` if given). Returns the session description.
+        """
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}")
+        if not 1 <= requests <= MAX_PROFILED_REQUESTS:
+            raise ValueError(f"requests must be between 1 and {MAX_PROFILED_REQUESTS}")
+        if not 0.001 <= interval <= 1:
+            raise ValueError("interval must be between 0.001 and 1 second")
+        now = time.monotonic()
+        with self._lock:
+            if self._session is not None and self._session["remaining"] > 0:
+                raise ProfilerBusy("A profiling session is already running")
+            if self._last_armed is not None and now - self._last_armed < self.min_interval:
+                raise ProfilerRateLimited(
+                    f"Profiling can be armed again in {int(self.min_interval - (now - self._last_armed)) + 1} s")
+            self._last_armed = now
+            self._session = {
+                "id": time.strftime("%Y%m%d-%H%M%S"),
+                "endpoint": endpoint,
+                "mode": mode,
+                "trace_memory": bool(trace_memory),
+                "interval": interval,
+                "remaining": requests,
+                "files": [],
+            }
+            return self.status()
+
+    def cancel(self):
+        with self._lock:
+            if self._session is not None:
+                self._session["remaining"] = 0
+
+    def status(self):
+        """
+        Return the current (or last) session: its settings, requests left and files written.
+        """
+        session = self._session
+        if session is None:
+            return {"active": False}
+        return dict(session, files=list(session["files"]), active=session["remaining"] > 0)
+
+    def _claim(self, endpoint):
+        """
+        Return (session, sequence number) if this request is to be profiled, otherwise None.
+        """
+        with self._lock:
+            session = self._session
+            if session is None or session["remaining"] <= 0 or self._busy:
+                return None
+            if session["endpoint"] is not None and session["endpoint"] != endpoint:
+                return None
+            session["remaining"] -= 1
+            self._busy = True
+            self.profiled += 1
+            return session, self.profiled
+
+    def _start(self, session, prefix):
+        token = current_profile.set(prefix)
+        memory = session["trace_memory"]
+        started_tracing = memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot() if memory else None
+        if session["mode"] == "cprofile":
+            recorder = cProfile.Profile()
+            recorder.enable()
+        else:
+            recorder = StackSampler(threading.get_ident(), session["interval"]).start()
+        return token, recorder, before, started_tracing
+
+    def _finish(self, session, prefix, state):
+        token, recorder, before, started_tracing = state
+        files = []
+        try:
+            if session["mode"] == "cprofile":
+                recorder.disable()
+                recorder.dump_stats(prefix + ".prof")
+                files.append(prefix + ".prof")
+            else:
+                counts = recorder.stop()
+                with open(prefix + ".collapsed", "w") as f:
+                    for stack, count in sorted(counts.items()):
+                        f.write(f"{stack} {count}\n")
+                files.append(prefix + ".collapsed")
+            if before is not None:
+                after = tracemalloc.take_snapshot()
+                if started_tracing:
+                    tracemalloc.stop()
+                with open(prefix + ".alloc.txt", "w") as f:
+                    for stat in after.compare_to(before, "lineno")[:TOP_ALLOCATIONS]:
+                        f.write(f"{stat}\n")
+                files.append(prefix + ".alloc.txt")
+            if os.path.exists(prefix + ".layout.prof"):
+                files.append(prefix + ".layout.prof")
+        except Exception as e:
+            logging.error("Writing profile %s failed: %s", prefix, e)
+        finally:
+            current_profile.reset(token)
+            with self._lock:
+                session["files"].extend(files)
+                self._busy = False
+
+    def _prefix(self, session, number, endpoint):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f"{session['id']}_{number:03d}_{endpoint}")
+
+    def wrap(self, view, endpoint):
+        """
+        Return view wrapped so that requests claimed by the armed session are profiled.
+        Async views are profiled on the thread running their event loop.
+        """
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def profiled(*args, **kwargs):
+                claimed = self._claim(endpoint)
+                if claimed is None:
+                    return await view(*args, **kwargs)
+                session, number = claimed
+                prefix = self._prefix(session, number, endpoint)
+                state = self._start(session, prefix)
+                try:
+                    return await view(*args, **kwargs)
+                finally:
+                    self._finish(session, prefix, state)
+        else:
+            @functools.wraps(view)
+            def profiled(*args, **kwargs):
+                claimed = self._claim(endpoint)
+                if claimed is None:
+                    return view(*args, **kwargs)
+                session, number = claimed
+                prefix = self._prefix(session, number, endpoint)
+                state = self._start(session, prefix)
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self._finish(session, prefix, state)
+        return profiled
+
+    def instrument(self, app):
+        """
+        Wrap every view of a Flask app registered so far.
+        """
+        for endpoint, view in list(app.view_functions.items()):
+            if endpoint != "static":
+                app.view_functions[endpoint] = self.wrap(view, endpoint)
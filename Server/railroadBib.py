@@ -2,7 +2,7 @@
 from __future__ import annotations
 
 import math as Math
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, NamedTuple
 
 if TYPE_CHECKING:
     from typing import (
@@ -37,7 +37,9 @@ INTERNAL_ALIGNMENT = (
 )
 CHAR_WIDTH = 8.5  # width of each monospace character. play until you find the right value for your font
 COMMENT_CHAR_WIDTH = 7  # comments are in smaller text by default
-TERMINAL_ID_COUNTER = 1
+PATH_PRECISION: Opt[int] = None  # decimals kept in path data; None writes numbers exactly as computed
+FIRST_TERMINAL_ID = 1  # terminals are numbered per Diagram, in depth-first order
+END_MARKER_ID = 100  # reserved: the highlight id of the end of the diagram, never given to a terminal
 
 
 def escapeAttr(val: Union[str, float]) -> str:
@@ -50,6 +52,35 @@ def escapeHtml(val: str) -> str:
     return escapeAttr(val).replace("<", "&lt;")
 
 
+def formatNumber(val: float, precision: Opt[int] = None) -> str:
+    if precision is None:
+        return str(val)
+    text = f"{val:.{precision}f}"
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+
+def formatPathData(segments: List[Union[str, float]], precision: Opt[int] = None) -> str:
+    # Commands are written verbatim, numbers following a command are separated by spaces
+    parts = []
+    afterNumber = False
+    for item in segments:
+        if isinstance(item, str):
+            parts.append(item)
+            afterNumber = False
+        else:
+            if afterNumber:
+                parts.append(" ")
+            parts.append(formatNumber(item, precision))
+            afterNumber = True
+    return "".join(parts)
+
+
+def formatAttrs(attrs: AttrsT) -> str:
+    return " ".join(f'{name}="{escapeAttr(value)}"' for name, value in sorted(attrs.items()))
+
+
 def determineGaps(outer: float, inner: float) -> Tuple[float, float]:
     diff = outer - inner
     if INTERNAL_ALIGNMENT == "left":
@@ -74,7 +105,38 @@ def addDebug(el: DiagramItem) -> None:
     )
 
 
+def writeChildren(children: Seq[Any], out: List[str]) -> None:
+    for child in children:
+        if isinstance(child, str):
+            out.append(escapeHtml(child))
+        else:
+            out.append("\n  ")  # Отступ для вложенных элементов
+            child.writeParts(out)
+
+
+class Element(NamedTuple):
+    # A plain SVG element (g, rect, text, marker...) produced by formatting; takes no part in layout
+    name: str
+    attrs: AttrsT
+    children: List[Any]
+
+    def addTo(self, parent: Union[DiagramItem, Element]) -> Element:
+        parent.children.append(self)
+        return self
+
+    def writeParts(self, out: List[str]) -> None:
+        out.append(f"<{self.name} {formatAttrs(self.attrs)}>")
+        writeChildren(self.children, out)
+        out.append(f"</{self.name}>")
+
+
+def element(name: str, attrs: Opt[AttrsT] = None, *children: Any) -> Element:
+    return Element(name, attrs or {}, list(children))
+
+
 class DiagramItem:
+    __slots__ = ("name", "up", "height", "down", "width", "needsSpace", "attrs", "children", "_attrText")
+
     def __init__(self, name: str, attrs: Opt[AttrsT] = None, text: Opt[Node] = None):
         self.name = name
         # up = distance it projects above the entry line
@@ -92,34 +154,40 @@ class DiagramItem:
         self.attrs: AttrsT = attrs or {}
         # Subclasses store their meaningful children as .item or .items;
         # .children instead stores their formatted SVG nodes.
-        self.children: List[Union[Node, Path, Style]] = [text] if text else []
+        self.children: List[Union[Node, Element, Path, Style]] = [text] if text else []
+        # Serialized attributes, built on first write
+        self._attrText: Opt[str] = None
 
     def format(self, x: float, y: float, width: float) -> DiagramItem:
         raise NotImplementedError  # Virtual
 
-    def addTo(self, parent: DiagramItem) -> DiagramItem:
+    def addTo(self, parent: Union[DiagramItem, Element]) -> DiagramItem:
         parent.children.append(self)
         return self
 
-    def writeSvg(self, write: WriterF) -> None:
-        # Открытие тега с атрибутами в одной строке для компактности
-        attrs = " ".join(f'{name}="{escapeAttr(value)}"' for name, value in sorted(self.attrs.items()))
-        write(f"<{self.name} {attrs}>")
+    def attrText(self) -> str:
+        if self._attrText is None:
+            self._attrText = formatAttrs(self.attrs)
+        return self._attrText
 
-        for child in self.children:
-            if isinstance(child, (DiagramItem, Path, Style)):
-                write("\n  ")  # Отступ для вложенных элементов
-                child.writeSvg(write)
-            else:
-                write(escapeHtml(child))
+    def writeParts(self, out: List[str]) -> None:
+        # Открытие тега с атрибутами в одной строке для компактности
+        out.append(f"<{self.name} {self.attrText()}>")
+        writeChildren(self.children, out)
+        out.append(f"</{self.name}>")
 
-        write(f"</{self.name}>")
+    def writeSvg(self, write: WriterF) -> None:
+        out: List[str] = []
+        self.writeParts(out)
+        write("".join(out))
 
     def walk(self, cb: WalkerF) -> None:
         cb(self)
 
 
 class DiagramMultiContainer(DiagramItem):
+    __slots__ = ("items",)
+
     def __init__(
             self,
             name: str,
@@ -140,23 +208,42 @@ class DiagramMultiContainer(DiagramItem):
 
 
 class Path:
+    __slots__ = ("x", "y", "segments", "markerStart", "markerEnd", "_attrText")
+
     def __init__(self, x: float, y: float):
         self.x = x
         self.y = y
-        self.attrs = {"d": f"M{x} {y}"}
+        # Flat list of commands, each followed by its numbers; the "d" attribute is only built on write
+        self.segments: List[Union[str, float]] = ["M", x, y]
+        self.markerStart: Opt[str] = None
+        self.markerEnd: Opt[str] = None
+        self._attrText: Opt[Tuple[Opt[int], str]] = None
+
+    @property
+    def attrs(self) -> AttrsT:
+        attrs: AttrsT = {"d": formatPathData(self.segments, PATH_PRECISION)}
+        if self.markerStart is not None:
+            attrs["marker-start"] = self.markerStart
+        if self.markerEnd is not None:
+            attrs["marker-end"] = self.markerEnd
+        return attrs
+
+    def append(self, command: str, *args: float) -> Path:
+        self.segments.append(command)
+        self.segments.extend(args)
+        self._attrText = None
+        return self
 
     def m(self, x: float, y: float) -> Path:
-        self.attrs["d"] += f"m{x} {y}"
-        return self
+        return self.append("m", x, y)
 
     def l(self, x: float, y: float) -> Path:
-        self.attrs["d"] += f"l{x} {y}"
-        return self
+        return self.append("l", x, y)
 
     def h(self, val: float, start_marker: bool = False, end_marker: bool = False, reverse: bool = False,
           far: bool = False) -> Path:
         """Горизонтальная линия с маркером на конце."""
-        self.attrs["d"] += f"h{val}"
+        self.append("h", val)
         if start_marker:
             self.add_start_marker(reverse=reverse, far=far)
         if end_marker:
@@ -166,7 +253,7 @@ class Path:
     def v(self, val: float, start_marker: bool = False, end_marker: bool = False, reverse: bool = False,
           far: bool = False) -> Path:
         """Вертикальная линия с маркером на конце."""
-        self.attrs["d"] += f"v{val}"
+        self.append("v", val)
         if start_marker:
             self.add_start_marker(reverse=reverse, far=far)
         if end_marker:
@@ -196,21 +283,23 @@ class Path:
     def add_start_marker(self, reverse: bool = False, far: bool = False) -> Path:
         """Добавить маркер на начало пути."""
         if far:
-            self.attrs["marker-start"] = "url(#far-arrow)"
+            self.markerStart = "url(#far-arrow)"
         elif reverse:
-            self.attrs["marker-start"] = "url(#reverse-arrow)"
+            self.markerStart = "url(#reverse-arrow)"
         else:
-            self.attrs["marker-start"] = "url(#arrow)"
+            self.markerStart = "url(#arrow)"
+        self._attrText = None
         return self
 
     def add_end_marker(self, reverse: bool = False, far: bool = False) -> Path:
         """Добавить маркер на конец пути."""
         if far:
-            self.attrs["marker-end"] = "url(#far-arrow)"
+            self.markerEnd = "url(#far-arrow)"
         elif reverse:
-            self.attrs["marker-end"] = "url(#reverse-arrow)"
+            self.markerEnd = "url(#reverse-arrow)"
         else:
-            self.attrs["marker-end"] = "url(#arrow)"
+            self.markerEnd = "url(#arrow)"
+        self._attrText = None
         return self
 
     def arc_8(self, start: str, dir: str) -> Path:
@@ -218,8 +307,7 @@ class Path:
         arc = AR
         s2 = 1 / Math.sqrt(2) * arc
         s2inv = arc - s2
-        sweep = "1" if dir == "cw" else "0"
-        path = f"a {arc} {arc} 0 0 {sweep} "
+        sweep = 1 if dir == "cw" else 0
         sd = start + dir
         offset: List[float]
         if sd == "ncw":
@@ -255,9 +343,7 @@ class Path:
         elif sd == "neccw":
             offset = [-s2, -s2inv]
 
-        path += " ".join(str(x) for x in offset)
-        self.attrs["d"] += path
-        return self
+        return self.append("a ", arc, arc, 0, 0, sweep, *offset)
 
     def arc(self, sweep: str, start_marker: bool = False, end_marker: bool = False, reverse: bool = False) -> Path:
         """Дуга с маркером на начале или конце."""
@@ -268,7 +354,7 @@ class Path:
         if sweep[0] == "s" or sweep[1] == "n":
             y *= -1
         cw = 1 if sweep in ("ne", "es", "sw", "wn") else 0
-        self.attrs["d"] += f"a{AR} {AR} 0 0 {cw} {x} {y}"
+        self.append("a", AR, AR, 0, 0, cw, x, y)
 
         if start_marker:
             self.add_start_marker(reverse=reverse)
@@ -277,19 +363,22 @@ class Path:
 
         return self
 
-    def addTo(self, parent: DiagramItem) -> Path:
+    def addTo(self, parent: Union[DiagramItem, Element]) -> Path:
         parent.children.append(self)
         return self
 
+    def writeParts(self, out: List[str]) -> None:
+        if self._attrText is None or self._attrText[0] != PATH_PRECISION:
+            self._attrText = (PATH_PRECISION, formatAttrs(self.attrs))
+        out.append(f"<path {self._attrText[1]} />")
+
     def writeSvg(self, write: WriterF) -> None:
-        write("<path")
-        for name, value in sorted(self.attrs.items()):
-            write(f' {name}="{escapeAttr(value)}"')
-        write(" />")
+        out: List[str] = []
+        self.writeParts(out)
+        write("".join(out))
 
     def format(self) -> Path:
-        self.attrs["d"] += "h.5"
-        return self
+        return self.append("h.5")  # written verbatim, as a command without numbers
 
     def __repr__(self) -> str:
         return f"Path({repr(self.x)}, {repr(self.y)})"
@@ -341,26 +430,35 @@ DEFAULT_STYLE = """\
 
 
 class Style:
+    __slots__ = ("css",)
+
     def __init__(self, css: str):
         self.css = css
 
     def __repr__(self) -> str:
         return f"Style({repr(self.css)})"
 
-    def addTo(self, parent: DiagramItem) -> Style:
+    def addTo(self, parent: Union[DiagramItem, Element]) -> Style:
         parent.children.append(self)
         return self
 
     def format(self) -> Style:
         return self
 
-    def writeSvg(self, write: WriterF) -> None:
+    def writeParts(self, out: List[str]) -> None:
         # Write included stylesheet as CDATA. See https:#developer.mozilla.org/en-US/docs/Web/SVG/Element/style
         cdata = "/* <![CDATA[ */\n{css}\n/* ]]> */\n".format(css=self.css)
-        write("<style>{cdata}</style>".format(cdata=cdata))
+        out.append("<style>{cdata}</style>".format(cdata=cdata))
+
+    def writeSvg(self, write: WriterF) -> None:
+        out: List[str] = []
+        self.writeParts(out)
+        write("".join(out))
 
 
 class Diagram(DiagramMultiContainer):
+    __slots__ = ("type", "formatted")
+
     def __init__(self, *items: Node, **kwargs: str):
         # Accepts a type=[simple|complex] kwarg
         DiagramMultiContainer.__init__(
@@ -392,6 +490,21 @@ class Diagram(DiagramMultiContainer):
         if self.items[-1].needsSpace:
             self.width -= 10
         self.formatted = False
+        self.numberTerminals()
+
+    def numberTerminals(self, start: int = FIRST_TERMINAL_ID) -> None:
+        # Ids depend only on the shape of the diagram, so identical input gives identical SVG
+        nextId = start
+
+        def visitor(item: DiagramItem) -> None:
+            nonlocal nextId
+            if isinstance(item, Terminal):
+                if nextId == END_MARKER_ID:
+                    nextId += 1
+                item.setId(nextId)
+                nextId += 1
+
+        self.walk(visitor)
 
     def __repr__(self) -> str:
         items = ", ".join(map(repr, self.items[1:-1]))
@@ -418,9 +531,7 @@ class Diagram(DiagramMultiContainer):
         assert paddingLeft is not None
         x = paddingLeft
         y = paddingTop + self.up
-        g = DiagramItem("g")
-        if STROKE_ODD_PIXEL_LENGTH:
-            g.attrs["transform"] = "translate(.5 .5)"
+        g = element("g", {"transform": "translate(.5 .5)"} if STROKE_ODD_PIXEL_LENGTH else None)
         for item in self.items:
             if item.needsSpace:
                 Path(x, y).h(10).addTo(g)
@@ -440,12 +551,36 @@ class Diagram(DiagramMultiContainer):
         self.formatted = True
         return self
 
+    def attrText(self) -> str:
+        # The root's attributes change between writes (size, xmlns), so they are not cached
+        return formatAttrs(self.attrs)
+
     def writeSvg(self, write: WriterF) -> None:
         if not self.formatted:
             self.format()
         return DiagramItem.writeSvg(self, write)
 
     def writeStandalone(self, write: WriterF, css: str | None = None) -> None:
+        write("".join(self.standaloneParts(css)))
+
+    def toStandalone(self, css: str | None = None) -> str:
+        return "".join(self.standaloneParts(css))
+
+    def iterStandalone(self, css: str | None = None, chunkSize: int = 65536) -> Generator[str, None, None]:
+        # Yields the standalone SVG in chunks of roughly chunkSize characters, e.g. for a streamed response
+        chunk: List[str] = []
+        size = 0
+        for part in self.standaloneParts(css):
+            chunk.append(part)
+            size += len(part)
+            if size >= chunkSize:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield "".join(chunk)
+
+    def standaloneParts(self, css: str | None = None) -> List[str]:
         if not self.formatted:
             self.format()
         if css is None:
@@ -453,10 +588,10 @@ class Diagram(DiagramMultiContainer):
         Style(css).addTo(self)
 
         # Определение маркеров стрелок
-        arrow_defs = DiagramItem("defs")
+        arrow_defs = element("defs")
 
         # Треугольник в конце пути
-        arrow_marker = DiagramItem("marker", {
+        arrow_marker = element("marker", {
             "id": "arrow",
             "viewBox": "0 0 10 10",
             "refX": "-5",  # Центр треугольника
@@ -465,7 +600,7 @@ class Diagram(DiagramMultiContainer):
             "markerHeight": "3",
             "orient": "auto"
         })
-        arrow_path = DiagramItem("polygon", {
+        arrow_path = element("polygon", {
             "points": "0,0 10,5 0,10",  # Указание координат треугольника
             "fill": "black"
         })
@@ -473,7 +608,7 @@ class Diagram(DiagramMultiContainer):
         arrow_marker.addTo(arrow_defs)
 
         # Добавить аналогичный reverse-arrow и far-arrow
-        reverse_arrow_marker = DiagramItem("marker", {
+        reverse_arrow_marker = element("marker", {
             "id": "reverse-arrow",
             "viewBox": "0 0 10 10",
             "refX": "-5",
@@ -482,14 +617,14 @@ class Diagram(DiagramMultiContainer):
             "markerHeight": "3",
             "orient": "auto-start-reverse"
         })
-        reverse_arrow_path = DiagramItem("polygon", {
+        reverse_arrow_path = element("polygon", {
             "points": "0,0 10,5 0,10",
             "fill": "black"
         })
         reverse_arrow_path.addTo(reverse_arrow_marker)
         reverse_arrow_marker.addTo(arrow_defs)
 
-        far_arrow_marker = DiagramItem("marker", {
+        far_arrow_marker = element("marker", {
             "id": "far-arrow",
             "viewBox": "0 0 10 10",
             "refX": "-5",  # Дальняя привязка для треугольника
@@ -498,7 +633,7 @@ class Diagram(DiagramMultiContainer):
             "markerHeight": "3",
             "orient": "auto"
         })
-        far_arrow_path = DiagramItem("polygon", {
+        far_arrow_path = element("polygon", {
             "points": "0,0 10,5 0,10",
             "fill": "black"
         })
@@ -510,13 +645,18 @@ class Diagram(DiagramMultiContainer):
         # Установить более тонкие пути
         self.attrs["xmlns"] = "http://www.w3.org/2000/svg"
         self.attrs['xmlns:xlink'] = "http://www.w3.org/1999/xlink"
-        DiagramItem.writeSvg(self, write)
-        self.children.pop()
+        out: List[str] = []
+        self.writeParts(out)
+        # Drop the temporary <defs> and <style> so the diagram can be written again
+        del self.children[-2:]
         del self.attrs["xmlns"]
         del self.attrs["xmlns:xlink"]
+        return out
 
 
 class Sequence(DiagramMultiContainer):
+    __slots__ = ()
+
     def __init__(self, *items: Node):
         DiagramMultiContainer.__init__(self, "g", items)
         self.needsSpace = True
@@ -559,6 +699,8 @@ class Sequence(DiagramMultiContainer):
 
 
 class Choice(DiagramMultiContainer):
+    __slots__ = ("default",)
+
     def __init__(self, default: int, *items: Node):
         DiagramMultiContainer.__init__(self, "g", items)
         assert default < len(items)
@@ -654,6 +796,8 @@ def Optional(item: Node, skip: bool = False) -> Choice:
 
 
 class OneOrMore(DiagramItem):
+    __slots__ = ("item", "rep")
+
     def __init__(self, item: Node, repeat: Opt[Node] = None):
         DiagramItem.__init__(self, "g")
         self.item = wrapString(item)
@@ -704,6 +848,8 @@ def ZeroOrMore(item: Node, repeat: Opt[Node] = None, skip: bool = False) -> Choi
 
 
 class Start(DiagramItem):
+    __slots__ = ("type", "label")
+
     def __init__(self, type: str = "simple", label: Opt[str] = None):
         DiagramItem.__init__(self, "g")
         if label:
@@ -723,10 +869,10 @@ class Start(DiagramItem):
         else:
             path.down(20).m(10, -20).down(20).m(-10, -10).right(self.width).addTo(self)
         if self.label:
-            DiagramItem(
+            element(
                 "text",
-                attrs={"x": x, "y": y - 15, "style": "text-anchor:start"},
-                text=self.label,
+                {"x": x, "y": y - 15, "style": "text-anchor:start"},
+                self.label,
             ).addTo(self)
         return self
 
@@ -735,6 +881,8 @@ class Start(DiagramItem):
 
 
 class End(DiagramItem):
+    __slots__ = ("type",)
+
     def __init__(self, type: str = "simple"):
         DiagramItem.__init__(self, "path")
         self.width = 20
@@ -748,6 +896,7 @@ class End(DiagramItem):
             self.attrs["d"] = "M {0} {1} h 20 m -10 -10 v 20 m 10 -20 v 20".format(x, y)
         elif self.type == "complex":
             self.attrs["d"] = "M {0} {1} h 20 m 0 -10 v 20".format(x, y)
+        self._attrText = None
         return self
 
     def __repr__(self) -> str:
@@ -755,10 +904,11 @@ class End(DiagramItem):
 
 
 class Terminal(DiagramItem):
+    __slots__ = ("text", "href", "title", "cls", "id")
+
     def __init__(
             self, text: str, href: Opt[str] = None, title: Opt[str] = None, cls: str = ""
     ):
-        global TERMINAL_ID_COUNTER
         DiagramItem.__init__(self, "g", {"class": " ".join(["terminal", cls])})
         self.text = text
         self.href = href
@@ -768,11 +918,16 @@ class Terminal(DiagramItem):
         self.up = 11
         self.down = 11
         self.needsSpace = True
-        self.id = TERMINAL_ID_COUNTER
-        TERMINAL_ID_COUNTER += 1
-        self.attrs["id"] = f"{self.id}"
+        # Assigned by the enclosing Diagram
+        self.id: Opt[int] = None
         addDebug(self)
 
+    def setId(self, id: int) -> Terminal:
+        self.id = id
+        self.attrs["id"] = f"{id}"
+        self._attrText = None
+        return self
+
     def __repr__(self) -> str:
         return (
             f"Terminal({repr(self.text)}, href={repr(self.href)}, "
@@ -786,7 +941,7 @@ class Terminal(DiagramItem):
         Path(x, y).h(leftGap).addTo(self)
         Path(x + leftGap + self.width, y).h(rightGap).addTo(self)
 
-        DiagramItem(
+        element(
             "rect",
             {
                 "x": x + leftGap,
@@ -797,20 +952,21 @@ class Terminal(DiagramItem):
                 "ry": 10,
             },
         ).addTo(self)
-        text = DiagramItem(
+        text = element(
             "text", {"x": x + leftGap + self.width / 2, "y": y + 4}, self.text
         )
         if self.href is not None:
-            a = DiagramItem("a", {"xlink:href": self.href}, text).addTo(self)
-            text.addTo(a)
+            element("a", {"xlink:href": self.href}, text).addTo(self)
         else:
             text.addTo(self)
         if self.title is not None:
-            DiagramItem("title", {}, self.title).addTo(self)
+            element("title", {}, self.title).addTo(self)
         return self
 
 
 class Skip(DiagramItem):
+    __slots__ = ()
+
     def __init__(self) -> None:
         DiagramItem.__init__(self, "g")
         self.width = 0
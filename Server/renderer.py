@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import logging
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from cache import LRUCache
+
+
+class RenderQueueFull(Exception):
+    """
+    Raised when too many graphs are already waiting to be rendered.
+    """
+
+
+class RenderTimeout(Exception):
+    """
+    Raised when GraphViz does not produce the SVG in time.
+    """
+
+
+def canonical_dot(dot):
+    """
+    Normalize the layout-neutral whitespace of a DOT text (indentation, line
+    endings, blank lines) so equal graphs share one cache entry.
+    """
+    lines = (line.strip() for line in dot.replace("\r\n", "\n").split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+def dot_key(dot):
+    """
+    Return the cache key of a DOT text: the SHA-256 of its canonical form.
+    """
+    return hashlib.sha256(canonical_dot(dot).encode("utf-8")).hexdigest()
+
+
+class GraphRenderer:
+    """
+    Renders DOT graphs to SVG through a cache and a bounded pool of render threads.
+
+    A cache miss runs one GraphViz process on one of max_workers long-lived
+    threads and the process is killed after timeout seconds. Requests for a graph
+    that is already being rendered wait for that render instead of starting
+    another process, and at most max_queue different graphs may be pending at a
+    time; past that render() raises RenderQueueFull instead of queueing more work.
+
+    render_async() is the same for async views: it starts GraphViz with
+    asyncio.create_subprocess_exec on the caller's event loop instead of a pool
+    thread, and shares the cache, the pending renders and the queue limit with render().
+    The duration of every GraphViz run is passed to observe("graphviz", seconds).
+    """
+
+    def __init__(self, max_workers=2, max_queue=32, timeout=10, cache=None, engine="dot", observe=None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.engine = engine
+        # Any cache backend; SVGs are plain strings, so shared backends work too
+        self.cache = LRUCache(maxsize=256) if cache is None else cache
+        self.rendered = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.observe = observe
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="graph-render")
+
+    def _timed_out(self, seconds):
+        with self._lock:
+            self.timeouts += 1
+        return RenderTimeout(f"Rendering the graph took longer than {seconds} s")
+
+    def _output(self, returncode, stdout, stderr):
+        if returncode != 0:
+            with self._lock:
+                self.errors += 1
+            message = stderr.decode("utf-8", "replace").strip()
+            raise ValueError(message or f"{self.engine} exited with status {returncode}")
+        return stdout.decode("utf-8")
+
+    def _observe(self, start):
+        if self.observe is not None:
+            self.observe("graphviz", time.perf_counter() - start)
+
+    def _run(self, dot):
+        start = time.perf_counter()
+        try:
+            result = subprocess.run([self.engine, "-Tsvg"], input=dot.encode("utf-8"),
+                                    capture_output=True, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            raise self._timed_out(self.timeout)
+        finally:
+            self._observe(start)
+        return self._output(result.returncode, result.stdout, result.stderr)
+
+    async def _run_async(self, dot):
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            self.engine, "-Tsvg", stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(dot.encode("utf-8")), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise self._timed_out(self.timeout)
+        finally:
+            self._observe(start)
+        return self._output(process.returncode, stdout, stderr)
+
+    def _render(self, key, dot):
+        try:
+            svg = self._run(dot)
+            self.cache.put(key, svg)
+            with self._lock:
+                self.rendered += 1
+            return svg
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+    def _claim(self, key, start):
+        """
+        Return (future, started, seconds to wait) for the render of key: the pending
+        render of the same graph if there is one, otherwise the future returned by start(key).
+        """
+        with self._lock:
+            future = self._pending.get(key)
+            started = future is None
+            if started:
+                if len(self._pending) >= self.max_queue:
+                    self.rejected += 1
+                    raise RenderQueueFull("Too many graphs are being rendered, try again later")
+                future = start(key)
+                self._pending[key] = future
+            # Time spent waiting behind the renders queued before this one
+            waiting = self.timeout * (1 + len(self._pending) // self.max_workers)
+        return future, started, waiting
+
+    def render(self, dot):
+        """
+        Return the SVG for a DOT text, from the cache or from a render worker.
+        """
+        dot = canonical_dot(dot)
+        key = hashlib.sha256(dot.encode("utf-8")).hexdigest()
+        svg = self.cache.get(key)
+        if svg is not None:
+            return svg
+        future, _, waiting = self._claim(key, lambda key: self._executor.submit(self._render, key, dot))
+        try:
+            return future.result(timeout=waiting)
+        except FutureTimeout:
+            logging.warning("Graph render %s still pending after %s s", key, waiting)
+            raise RenderTimeout(f"Rendering the graph took longer than {waiting} s")
+
+    async def render_async(self, dot):
+        """
+        Return the SVG for a DOT text, from the cache or from a GraphViz process run on the event loop.
+        """
+        dot = canonical_dot(dot)
+        key = hashlib.sha256(dot.encode("utf-8")).hexdigest()
+        svg = self.cache.get(key)
+        if svg is not None:
+            return svg
+        future, started, waiting = self._claim(key, lambda key: Future())
+        if not started:
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), waiting)
+            except asyncio.TimeoutError:
+                logging.warning("Graph render %s still pending after %s s", key, waiting)
+                raise RenderTimeout(f"Rendering the graph took longer than {waiting} s")
+        try:
+            svg = await self._run_async(dot)
+            self.cache.put(key, svg)
+            with self._lock:
+                self.rendered += 1
+            future.set_result(svg)
+            return svg
+        except BaseException as e:
+            # Hand the failure to the requests waiting for the same graph
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        """
+        Return the cache counters and the pending / rendered / rejected render counts.
+        """
+        with self._lock:
+            stats = {
+                "pending": len(self._pending),
+                "max_queue": self.max_queue,
+                "workers": self.max_workers,
+                "rendered": self.rendered,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+            }
+        stats["cache"] = self.cache.stats()
+        return stats
@@ -0,0 +1,161 @@
+import math
+import re
+import threading
+
+from railroadBib import escapeHtml, formatNumber
+
+LAYER_SPACING = 110  # horizontal distance between layers
+ROW_SPACING = 60  # vertical distance between nodes of one layer
+NODE_RADIUS = 18
+MARGIN = 45  # leaves room for the self-loops of the first row
+LOOP_HEIGHT = 35
+CURVE_BEND = 40  # how far back edges bulge away from the straight line
+STATE_NAME = re.compile(r"^[A-Za-z0-9_]{1,64}$")
+
+
+def format_point(x, y):
+    return f"{formatNumber(x, 1)} {formatNumber(y, 1)}"
+
+
+class StateGraph:
+    """
+    A state graph that is laid out incrementally, one edge at a time.
+
+    Nodes are placed in left-to-right layers: a node first seen without an incoming
+    edge goes to layer 0, a node reached through an edge goes one layer to the right
+    of the edge's source, below the nodes already in that layer. Positions never
+    change once assigned, so an edge delta only produces SVG for the new node and the
+    new (or relabelled) edge, which the client patches into the SVG it already shows.
+    Edges between the same pair of states share one arrow labelled with all their symbols.
+    """
+
+    def __init__(self):
+        self.positions = {}
+        self.layers = {}
+        self.layer_sizes = []
+        self.edges = {}
+        self._lock = threading.Lock()
+
+    def _place(self, name, layer):
+        if not STATE_NAME.match(name):
+            raise ValueError(f"Invalid state name: {name!r}")
+        while len(self.layer_sizes) <= layer:
+            self.layer_sizes.append(0)
+        row = self.layer_sizes[layer]
+        self.layer_sizes[layer] += 1
+        self.layers[name] = layer
+        self.positions[name] = (MARGIN + NODE_RADIUS + layer * LAYER_SPACING,
+                                MARGIN + NODE_RADIUS + row * ROW_SPACING)
+
+    def _add_edge(self, source, symbol, target, changed):
+        if source not in self.positions:
+            self._place(source, 0)
+            changed[("node", source)] = None
+        if target not in self.positions:
+            self._place(target, self.layers[source] + 1)
+            changed[("node", target)] = None
+        symbols = self.edges.setdefault((source, target), [])
+        if symbol not in symbols:
+            symbols.append(symbol)
+            changed[("edge", (source, target))] = None
+
+    def apply(self, nodes=(), edges=()):
+        """
+        Add states and (source, symbol, target) edges. Returns the patch for the client:
+        the coordinates of the new nodes, the SVG of every new or changed element
+        (keyed by its element id) and the new size of the drawing.
+        """
+        # Insertion-ordered set of the elements to send, an edge relabelled twice is sent once
+        changed = {}
+        with self._lock:
+            for name in nodes:
+                if name not in self.positions:
+                    self._place(name, 0)
+                    changed[("node", name)] = None
+            for source, symbol, target in edges:
+                self._add_edge(source, str(symbol), target, changed)
+            patch = []
+            for kind, key in changed:
+                if kind == "node":
+                    patch.append({"id": self.node_id(key), "group": "nodes", "svg": self.node_svg(key)})
+                else:
+                    patch.append({"id": self.edge_id(*key), "group": "edges", "svg": self.edge_svg(*key)})
+            width, height = self.size()
+            return {
+                "nodes": {key: self.positions[key] for kind, key in changed if kind == "node"},
+                "patch": patch,
+                "width": width,
+                "height": height,
+            }
+
+    def size(self):
+        if not self.layer_sizes:
+            return 0, 0
+        width = 2 * (MARGIN + NODE_RADIUS) + (len(self.layer_sizes) - 1) * LAYER_SPACING
+        height = 2 * (MARGIN + NODE_RADIUS) + (max(self.layer_sizes) - 1) * ROW_SPACING
+        return width, height
+
+    @staticmethod
+    def node_id(name):
+        return f"node-{name}"
+
+    @staticmethod
+    def edge_id(source, target):
+        return f"edge-{source}-{target}"
+
+    def node_svg(self, name):
+        x, y = self.positions[name]
+        return (f'<g id="{self.node_id(name)}" class="node">'
+                f'<circle cx="{x}" cy="{y}" r="{NODE_RADIUS}" fill="white" stroke="black"></circle>'
+                f'<text x="{x}" y="{y}" text-anchor="middle" dominant-baseline="central">{escapeHtml(name)}</text>'
+                f'</g>')
+
+    def edge_svg(self, source, target):
+        sx, sy = self.positions[source]
+        tx, ty = self.positions[target]
+        if source == target:
+            top = sy - NODE_RADIUS
+            d = (f"M{format_point(sx - 8, top + 2)} C{format_point(sx - 25, top - LOOP_HEIGHT)} "
+                 f"{format_point(sx + 25, top - LOOP_HEIGHT)} {format_point(sx + 8, top + 2)}")
+            lx, ly = sx, top - LOOP_HEIGHT + 4
+        else:
+            dx, dy = tx - sx, ty - sy
+            length = math.hypot(dx, dy)
+            ux, uy = dx / length, dy / length
+            if self.layers[target] > self.layers[source]:
+                # Forward edges are straight
+                cx, cy = (sx + tx) / 2, (sy + ty) / 2
+            else:
+                # Back edges and edges inside a layer bend so they do not overlap forward ones
+                cx, cy = (sx + tx) / 2 + uy * CURVE_BEND, (sy + ty) / 2 - ux * CURVE_BEND
+            # Start and end on the circles, heading towards the control point
+            ax, ay = cx - sx, cy - sy
+            bx, by = cx - tx, cy - ty
+            a, b = math.hypot(ax, ay), math.hypot(bx, by)
+            start = (sx + ax / a * NODE_RADIUS, sy + ay / a * NODE_RADIUS)
+            end = (tx + bx / b * NODE_RADIUS, ty + by / b * NODE_RADIUS)
+            d = f"M{format_point(*start)} Q{format_point(cx, cy)} {format_point(*end)}"
+            lx = (start[0] + 2 * cx + end[0]) / 4
+            ly = (start[1] + 2 * cy + end[1]) / 4 - 6
+        label = ",".join(self.edges[(source, target)])
+        return (f'<g id="{self.edge_id(source, target)}" class="edge">'
+                f'<path d="{d}" fill="none" stroke="black" marker-end="url(#state-graph-arrow)"></path>'
+                f'<text x="{formatNumber(lx, 1)}" y="{formatNumber(ly, 1)}" text-anchor="middle">'
+                f'{escapeHtml(label)}</text></g>')
+
+    def to_svg(self):
+        """
+        Return the whole graph as one SVG document (used for the first render and resyncs).
+        """
+        with self._lock:
+            width, height = self.size()
+            edges = "".join(self.edge_svg(source, target) for source, target in self.edges)
+            nodes = "".join(self.node_svg(name) for name in self.positions)
+        return (f'<svg xmlns="http://www.w3.org/2000/svg" class="state-graph" width="{width}" height="{height}" '
+                f'viewBox="0 0 {width} {height}">'
+                f'<defs><marker id="state-graph-arrow" viewBox="0 0 10 10" refX="10" refY="5" '
+                f'markerWidth="8" markerHeight="8" orient="auto"><path d="M0 0 L10 5 L0 10 z"></path></marker></defs>'
+                f'<g class="edges">{edges}</g><g class="nodes">{nodes}</g></svg>')
+
+    def __len__(self):
+        return len(self.positions)
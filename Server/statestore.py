@@ -0,0 +1,144 @@
+import base64
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from cache import LRUCache
+
+
+def make_handle(*parts):
+    """
+    Return a short opaque handle (16 url-safe characters) derived from parts.
+    """
+    digest = hashlib.blake2b("\x00".join(map(str, parts)).encode("utf-8"), digest_size=12).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii")
+
+
+class StateStore:
+    """
+    Server-side store of parser states addressed by short opaque handles.
+
+    A state is (regex, terminal ids, state bitset). The regex and its ids are stored
+    once per regex, the state once per (regex, bitset); handles are derived from the
+    content, so reaching a state again yields the same handle and storing it is a no-op.
+    The client (cookie or request body) only ever carries a handle, whatever the
+    length of the session. Subclasses provide the storage.
+    """
+
+    def put(self, regex, id_list, state):
+        """
+        Store a state and return its handle.
+        """
+        machine = make_handle("regex", regex)
+        if self._load_machine(machine) is None:
+            self._save_machine(machine, regex, list(id_list))
+        handle = make_handle("state", regex, state)
+        self._save_state(handle, machine, state)
+        return handle
+
+    def get(self, handle):
+        """
+        Return (regex, id_list, state) for a handle, or None if it is unknown or expired.
+        """
+        if not isinstance(handle, str):
+            return None
+        entry = self._load_state(handle)
+        if entry is None:
+            return None
+        machine, state = entry
+        record = self._load_machine(machine)
+        if record is None:
+            return None
+        regex, id_list = record
+        return regex, id_list, state
+
+
+class MemoryStateStore(StateStore):
+    """
+    Keeps states in process memory (least recently used ones are dropped first).
+    """
+
+    def __init__(self, maxsize=100000, max_regexes=4096):
+        self._machines = LRUCache(maxsize=max_regexes)
+        self._states = LRUCache(maxsize=maxsize)
+
+    def _load_machine(self, machine):
+        return self._machines.get(machine)
+
+    def _save_machine(self, machine, regex, id_list):
+        self._machines.put(machine, (regex, id_list))
+
+    def _load_state(self, handle):
+        return self._states.get(handle)
+
+    def _save_state(self, handle, machine, state):
+        self._states.put(handle, (machine, state))
+
+    def stats(self):
+        return {"backend": "memory", "states": len(self._states), "regexes": len(self._machines)}
+
+
+class SqliteStateStore(StateStore):
+    """
+    Keeps states in a sqlite database, shared by every process of the server and kept
+    across restarts. States not stored again for max_age_seconds are pruned.
+    """
+
+    PRUNE_EVERY = 1000  # writes between two prunes
+
+    def __init__(self, path, max_age_seconds=7 * 86400):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS machines "
+                             "(machine TEXT PRIMARY KEY, regex TEXT NOT NULL, ids TEXT NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS states (handle TEXT PRIMARY KEY, "
+                             "machine TEXT NOT NULL, state TEXT NOT NULL, stored REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS states_stored ON states (stored)")
+
+    def _load_machine(self, machine):
+        with self._lock:
+            row = self._db.execute("SELECT regex, ids FROM machines WHERE machine = ?", (machine,)).fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def _save_machine(self, machine, regex, id_list):
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO machines VALUES (?, ?, ?)",
+                             (machine, regex, json.dumps(id_list)))
+
+    def _load_state(self, handle):
+        with self._lock:
+            row = self._db.execute("SELECT machine, state FROM states WHERE handle = ?", (handle,)).fetchone()
+        # Bitsets can be wider than sqlite integers, they are stored as hex text
+        return None if row is None else (row[0], int(row[1], 16))
+
+    def _save_state(self, handle, machine, state):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?)",
+                             (handle, machine, format(state, "x"), time.time()))
+            self._writes += 1
+            prune = self._writes % self.PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def prune(self, now=None):
+        """
+        Delete states older than max_age_seconds and regexes no state refers to any more.
+        """
+        deadline = (time.time() if now is None else now) - self.max_age_seconds
+        with self._lock:
+            removed = self._db.execute("DELETE FROM states WHERE stored < ?", (deadline,)).rowcount
+            self._db.execute("DELETE FROM machines WHERE machine NOT IN (SELECT DISTINCT machine FROM states)")
+        return removed
+
+    def stats(self):
+        with self._lock:
+            states = self._db.execute("SELECT COUNT(*) FROM states").fetchone()[0]
+            machines = self._db.execute("SELECT COUNT(*) FROM machines").fetchone()[0]
+        return {"backend": "sqlite", "path": self.path, "states": states, "regexes": machines}